@@ -0,0 +1,186 @@
+import sys
+import os
+import argparse
+import contextlib
+import json
+import random
+import subprocess
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    resource = None # no peak RSS outside of unix
+from specter_sim import *
+from specter_replay import replay
+
+
+DEPTHS=[2, 4, 6, 8]
+N_HUNTERS=4
+
+
+# returns a synthetic game log of turns propagations, in the format read by
+#  Sim.init_from_file
+#
+# a true agent takes a random walk from the start and every turn the hunters report what
+#  they would really see, so the log is consistent and the particles never all die out.
+#  with equip, the agent plays hidden equipment (and may surge) every fourth turn
+def synthetic_log(turns, equip=False, seed=0):
+    rnd = random.Random(seed)
+    board = Board()
+    cells = [BoardPosition.from_index(i) for i in range(N_ROWS*N_COLS)]
+    open_cells = [p for p in cells if board.is_transparent(p)]
+    lines=[]
+    pos = BoardPosition.from_index(Agent.START_CELL)
+    for t in range(1, turns+1):
+        surge = equip and t % 4 == 1
+        if surge:
+            lines.append('hidden')
+        lines.append('propagate %d' % t)
+        for m in range(rnd.randint(0, NUM_MOVES_PER_TURN_SURGE if surge else NUM_MOVES_PER_TURN)):
+            pos = rnd.choice(board.adjacent(pos, only_passable=True))
+        # hunters look for the agent from nearby, and every third turn one gets a sighting
+        for h in range(N_HUNTERS):
+            near = [p for p in open_cells if p.dist(pos) <= 8]
+            hp = rnd.choice(near)
+            hp = BoardPosition(hp.row, hp.col, rnd.randrange(-1, 4))
+            seen = t % 3 == 0 and h == 0 or pos in board.hunter_los(hp)
+            if seen and pos not in board.hunter_los(hp):
+                hp = BoardPosition(pos.row, pos.col)
+            lines.append('spotted %s %s' % (str(pos) if seen else '??', str(hp)))
+            if seen:
+                break
+        hp = rnd.choice(open_cells)
+        lines.append('sniffed %s %s' % (str(hp), hp.dist(pos) <= SNIFF_RANGE))
+    return '\n'.join(lines) + '\n'
+
+
+# peak resident set size of this process in MB, or None if it can't be measured
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+# replays a synthetic game and returns the time, particles in and out and particles per
+#  second for each kind of command
+#
+# particles per second counts the particles coming out of propagate and going into the
+#  observations, as those are what each stage has to work through
+def run_case(turns, equip, seed=0, engine=Sim.ENGINE_PATHS, workers=1, lazy=False):
+    with tempfile.NamedTemporaryFile('wt', suffix='.txt', delete=False) as fd:
+        fd.write(synthetic_log(turns, equip, seed))
+        log_file = fd.name
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            res = replay(log_file, engine=engine, workers=workers, lazy=lazy)
+    finally:
+        os.remove(log_file)
+    wall = time.perf_counter() - start
+
+    stages={}
+    particles = 1
+    for c in res['commands']:
+        s = stages.setdefault(c['command'], {'calls': 0, 'seconds': 0.0, 'particles_in': 0, 'particles_out': 0})
+        s['calls'] += 1
+        s['seconds'] += c['seconds']
+        # a lazy propagation's particles aren't counted until they're made
+        if c['particles'] is None:
+            continue
+        s['particles_in'] += particles
+        s['particles_out'] += c['particles']
+        particles = c['particles']
+    for name, s in stages.items():
+        n = s['particles_out'] if name == 'propagate' else s['particles_in']
+        s['particles_per_second'] = n / s['seconds'] if s['seconds'] > 0 and (n > 0 or not lazy) else None
+    return {'turns': turns, 'equip': equip, 'seed': seed, 'engine': engine, 'workers': workers, 'lazy': lazy,
+            'wall_seconds': wall, 'peak_rss_mb': peak_rss(), 'particles': res['particles'],
+            'stages': stages}
+
+
+# times the board's own line of sight and road lookups over every transparent cell
+def run_board():
+    board = Board()
+    cells = [BoardPosition(r, c) for r in range(N_ROWS) for c in range(N_COLS)]
+    cells = [p for p in cells if board.is_transparent(p)]
+    res={}
+    start = time.perf_counter()
+    for p in cells:
+        for d in range(-1, 4):
+            board.hunter_los(BoardPosition(p.row, p.col, d))
+    res['hunter_los'] = {'calls': len(cells)*5, 'seconds': time.perf_counter() - start}
+    start = time.perf_counter()
+    for p in cells:
+        board.roads_connected_to(p)
+    res['roads_connected_to'] = {'calls': len(cells), 'seconds': time.perf_counter() - start}
+    start = time.perf_counter()
+    for p in cells:
+        i = p.index()
+        for d in range(4):
+            board.road_lanes(i, d)
+    res['road_lanes'] = {'calls': len(cells)*4, 'seconds': time.perf_counter() - start}
+    for s in res.values():
+        s['calls_per_second'] = s['calls'] / s['seconds'] if s['seconds'] > 0 else None
+    return res
+
+
+# each case runs in its own process so the peak RSS is its own
+def run_subprocess(args):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__)] + args,
+                         stdout=subprocess.PIPE, check=True, cwd=os.getcwd())
+    return json.loads(out.stdout)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark propagation and observations on synthetic games')
+    parser.add_argument( '--depths',  help='Number of turns to play',         nargs='+', type=int, default=DEPTHS )
+    parser.add_argument( '--seed',    help='Seed for the synthetic games',    type=int, default=0 )
+    parser.add_argument( '--engine',  help='Propagation engine: every move sequence (paths), reachability classes (reach) or merged states without histories (belief, needs numpy)',
+                         choices=[Sim.ENGINE_PATHS, Sim.ENGINE_REACH, Sim.ENGINE_BELIEF], default=Sim.ENGINE_PATHS )
+    parser.add_argument( '--workers', help='Number of processes to propagate with', default=1, type=int )
+    parser.add_argument( '--lazy',    help='Make the agents of each propagation only once the observations that follow can filter them',
+                         action='store_true' )
+    parser.add_argument( '--output',  help='Write results here instead of stdout', default=None )
+    parser.add_argument( '--write-logs', help='Save the synthetic logs in this directory and exit', default=None )
+    # used to run a single case in a child process
+    parser.add_argument( '--case',    help=argparse.SUPPRESS, nargs=2, type=int, default=None )
+    parser.add_argument( '--board',   help=argparse.SUPPRESS, action='store_true' )
+
+    main_args = parser.parse_args(argv)
+
+    if main_args.case is not None:
+        json.dump(run_case(main_args.case[0], main_args.case[1] != 0, main_args.seed,
+                           main_args.engine, main_args.workers, main_args.lazy), sys.stdout)
+        return
+    if main_args.board:
+        json.dump(run_board(), sys.stdout)
+        return
+    if main_args.write_logs is not None:
+        for turns in main_args.depths:
+            for equip in (False, True):
+                name = 'synthetic_%d%s.txt' % (turns, '_equip' if equip else '')
+                with open(os.path.join(main_args.write_logs, name), 'wt') as fd:
+                    fd.write(synthetic_log(turns, equip, main_args.seed))
+        return
+
+    results = {'python': sys.version.split()[0], 'numpy': np is not None, 'board': run_subprocess(['--board']), 'cases': []}
+    for turns in main_args.depths:
+        for equip in (False, True):
+            print('%d turns%s' % (turns, ' with equipment' if equip else ''), file=sys.stderr)
+            results['cases'].append(run_subprocess(['--case', str(turns), '1' if equip else '0',
+                                                    '--seed', str(main_args.seed), '--engine', main_args.engine,
+                                                    '--workers', str(main_args.workers)] +
+                                                   (['--lazy'] if main_args.lazy else [])))
+
+    fd = open(main_args.output, 'wt') if main_args.output is not None else sys.stdout
+    json.dump(results, fd, indent=1)
+    fd.write('\n')
+    if fd is not sys.stdout:
+        fd.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,949 +1,33 @@
 import sys
+import os
 import argparse
-import csv
+import threading
+import traceback
 import tkinter as tk
 from PIL import ImageTk,Image
+from specter_sim import *
 
 
-N_ROWS=32
-N_COLS=23
-FIRST_ROW=1
-FIRST_COL=ord('A')
-ROWS=[118, 747]
-DROW=(ROWS[1]-ROWS[0])/N_ROWS
-COLS=[26, 480]
-DCOL=(COLS[1]-COLS[0])/N_COLS
-N_TURNS=40
-TURNS_COL=538
-TURNS_ROW=[40, 721]
-DTURN=(TURNS_ROW[1]-TURNS_ROW[0])/N_TURNS
-PROB_RECT_OFFSET=2
-
-NUM_MOVES_PER_TURN=4
-NUM_MOVES_PER_TURN_SURGE=6
-MOTION_DETECT_MOVES=3
-SNIFF_RANGE=4
-GRENADE_RANGE=4
-STEALTH_RANGE=2
-
-ROAD='.'
-PATH=' '
-WALL='#'
-SMOKE_GRENADE='*'
-
-
-
-class BoardPosition():
-    D_LOOKUP=['E','N','W','S']
-
-    @staticmethod
-    def str2rcd(index):
-        if len(index) == 0:
-            c = -1
-            r = -1
-            d = -1
-        else:
-            c = ord(index[0].upper()) - FIRST_COL
-            # handle if direction is specified in string
-            try:
-                d = BoardPosition.D_LOOKUP.index(index[-1].upper())
-            except:
-                d = -1
-                r = int(index[1:]) - FIRST_ROW
-            else:
-                r = int(index[1:-1]) - FIRST_ROW
-        return r,c,d
-
-    def  __init__(self, r=-1, c=-1, d=-1):
-        self.row = r
-        self.col = c
-        self.d   = d
-
-    @classmethod
-    def from_string(cls, index):
-        r,c,d = BoardPosition.str2rcd(index)
-        return BoardPosition(r,c,d)
-
-    @classmethod
-    def clone(cls, other):
-        r = other.row
-        c = other.col
-        d = other.d
-        return BoardPosition(r,c,d)
-
-    def __str__(self):
-        if self.on_board():
-            return chr(self.col + FIRST_COL) + str(self.row + FIRST_ROW) + ('' if self.d == -1 else self.D_LOOKUP[self.d])
-        else:
-            return "??"
-
-    def __eq__(self,rhs):
-        return self.row == rhs.row and self.col == rhs.col
-
-    # note: this ordering isn't correct in the strictest sense, but for positions in the same
-    #  row/col (the intended use case), it works fine
-    def __le__(self,rhs):
-        return (self.row <= rhs.row and self.col <= rhs.col)
-
-    def __lt__(self,rhs):
-        return self.__le__(rhs) and not self.__eq__(rhs)
-
-    def __ge__(self,rhs):
-        return (self.row >= rhs.row and self.col >= rhs.col)
-
-    def __gt__(self,rhs):
-        return self.__ge__(rhs) and not self.__eq__(rhs)
-
-    def set(self, index):
-        r,c,d = BoardPosition.str2rcd(index)
-        self.row = r
-        self.col = c
-        self.d   = d
-
-    def on_board(self):
-        return self.col >=0 and self.col < N_COLS and self.row >= 0 and self.row < N_ROWS
-
-    def screen_pos(self):
-        if self.on_board():
-            y=self.row*DROW+ROWS[0]
-            x=self.col*DCOL+COLS[0]
-            return y,x
-        else:
-            return 0,0
-
-    # return true if self is east of rhs
-    def east_of(self,rhs):
-        return self.col > rhs.col
-
-    # return true if self is west of rhs
-    def west_of(self,rhs):
-        return self.col < rhs.col
-
-    # return true if self is north of rhs
-    def north_of(self,rhs):
-        return self.row < rhs.row
-
-    # return true if self is south of rhs
-    def south_of(self,rhs):
-        return self.row > rhs.row
-
-    # return the "distance" between two positions, which is the max of
-    #  the row and column differences
-    def dist(self,other):
-        return max([abs(self.row - other.row), abs(self.col - other.col)])
-
-
-class Board():
-    def __init__(self,init_empty=False):
-        self.smokep = None
-        self.board_cells = [[0 for c in range(N_COLS)] for r in range(N_ROWS)]
-        self.backup = [[0 for c in range(N_COLS)] for r in range(N_ROWS)]
-        if not init_empty:
-          with open('board.csv','rt') as fd:
-              board_reader = csv.reader(fd)
-              r = 0
-              for row in board_reader:
-                  for c,val in enumerate(row):
-                      self.board_cells[r][c] = val
-                      self.backup[r][c] = val
-                  r += 1
-
-    def get(self, bp):
-        return self.board_cells[bp.row][bp.col]
-
-    def set(self, bp, val):
-        self.board_cells[bp.row][bp.col] = val
-
-    def place_smoke(self, bp):
-        # should only occur if testing
-        if self.smokep is not None:
-            self.clear_smoke()
-        self.smokep = bp
-        adj = self.adjacent(self.smokep, only_passable=True)
-        for p in adj:
-            self.set(p, SMOKE_GRENADE)
-
-    def clear_smoke(self):
-        adj = self.adjacent(self.smokep, only_passable=True)
-        for p in adj:
-            self.set(p, self.backup[p.row][p.col])
-        self.smokep = None
-
-    def contains(self, bp):
-        return bp.col >=0 and bp.col < N_COLS and bp.row >= 0 and bp.row < N_ROWS
-
-    def is_road(self, bp):
-        # check backup board because main might have been overwritten with SMOKE
-        return self.backup[bp.row][bp.col] == ROAD
-
-    def is_passable(self, bp):
-        cell = self.get(bp)
-        return cell == ROAD or cell == PATH or cell == SMOKE_GRENADE
-
-    def is_wall(self, bp):
-        cell = self.get(bp)
-        return cell == WALL
-
-    def is_transparent(self, bp):
-        cell = self.get(bp)
-        return cell == ROAD or cell == PATH
-
-    def is_objective(self, bp):
-        cell = self.get(bp)
-        return cell >= 'a' and cell <= 'z'
-
-    # returns list of positions adjacent to bp, with the optional condition they must be passable
-    def adjacent(self, bp, dist=1, only_passable=False):
-        n=[]
-        for r in range(bp.row-dist, bp.row+dist+1):
-            for c in range(bp.col-dist, bp.col+dist+1):
-                if r >= 0 and r < N_ROWS and c >= 0 and c < N_COLS and (r != bp.row or c != bp.col):
-                    nbp = BoardPosition(r,c)
-                    if not only_passable or self.is_passable(nbp):
-                        n.append(nbp)
-        return n
-
-    def roads_connected_to(self, bp):
-        rl = {'E':[],'N':[],'W':[],'S':[]} # list of board positions for e/n/w/s roads
-        if self.is_road(bp):
-            # travel e/w to find e/w road extent
-            rp = BoardPosition(bp.row, bp.col)
-            road_east_terminus = bp.col
-            for c in range(bp.col+1,N_COLS):
-                rp.col = c
-                if self.contains(rp) and self.is_road(rp):
-                    road_east_terminus=c
-                else:
-                    break
-            road_west_terminus = bp.col
-            for c in range(bp.col-1, -1, -1):
-                rp.col = c
-                if self.contains(rp) and self.is_road(rp):
-                    road_west_terminus=c
-                else:
-                    break
-            if road_east_terminus - road_west_terminus > 1:
-                # determine which n/s adjacent is rame road (if any)
-                ew_other_row = bp.row - 1
-                rpe = BoardPosition(ew_other_row, road_east_terminus)
-                rpw = BoardPosition(ew_other_row, road_west_terminus)
-                if not (self.contains(rpe) and self.contains(rpw) and self.is_road(rpe) and self.is_road(rpw)):
-                    ew_other_row = bp.row + 1
-            else:
-                ew_other_row = -1
-            if ew_other_row != -1:
-                for c in range(bp.col+1, road_east_terminus+1):
-                    rl['E'].append(BoardPosition(bp.row, c))
-                    rl['E'].append(BoardPosition(ew_other_row, c))
-                for c in range(road_west_terminus, bp.col):
-                    rl['W'].append(BoardPosition(bp.row, c))
-                    rl['W'].append(BoardPosition(ew_other_row, c))
-
-            # travel n/s to find n/s road extent
-            rp = BoardPosition(bp.row, bp.col)
-            road_south_terminus = bp.row
-            for r in range(bp.row+1,N_ROWS):
-                rp.row = r
-                if self.contains(rp) and self.is_road(rp):
-                    road_south_terminus=r
-                else:
-                    break
-            road_north_terminus = bp.row
-            for r in range(bp.row-1, -1, -1):
-                rp.row = r
-                if self.contains(rp) and self.is_road(rp):
-                    road_north_terminus=r
-                else:
-                    break
-            if road_south_terminus - road_north_terminus > 1:
-                # determine which e/w adjacent is rame road (if any)
-                ns_other_col = bp.col - 1
-                rps = BoardPosition(road_south_terminus, ns_other_col)
-                rpn = BoardPosition(road_north_terminus, ns_other_col)
-                if not (self.contains(rps) and self.contains(rpn) and self.is_road(rps) and self.is_road(rpn)):
-                    ns_other_col = bp.col + 1
-            else:
-                ns_other_col = -1
-            if ns_other_col != -1:
-                for r in range(road_north_terminus, bp.row):
-                    rl['N'].append(BoardPosition(r, bp.col))
-                    rl['N'].append(BoardPosition(r, ns_other_col))
-                for r in range(bp.row+1, road_south_terminus+1):
-                    rl['S'].append(BoardPosition(r, bp.col))
-                    rl['S'].append(BoardPosition(r, ns_other_col))
-        # now, re-order the roads so they start at bp and move outward, first starting with
-        #  the same row/col, then moving to the adjacent row/col
-        rl['E'] = [sorted([p for p in rl['E'] if p.row == bp.row]),
-                   sorted([p for p in rl['E'] if p.row != bp.row])]
-        rl['W'] = [sorted([p for p in rl['W'] if p.row == bp.row], reverse=True),
-                   sorted([p for p in rl['W'] if p.row != bp.row], reverse=True)]
-        rl['S'] = [sorted([p for p in rl['S'] if p.col == bp.col]),
-                   sorted([p for p in rl['S'] if p.col != bp.col])]
-        rl['N'] = [sorted([p for p in rl['N'] if p.col == bp.col], reverse=True),
-                   sorted([p for p in rl['N'] if p.col != bp.col], reverse=True)]
-        return rl
-
-    def hunter_los(self, hp):
-        los = [hp]
-        if self.is_transparent(hp):
-            all_roads = self.roads_connected_to(hp)
-
-            # hunter is looking E
-            if hp.d == 0 or hp.d == -1:
-                # accumulate LOS along this row
-                for c in range(hp.col+1, N_COLS):
-                    bp = BoardPosition(hp.row, c)
-                    if self.is_transparent(bp):
-                        los.append(bp)
-                    else:
-                        break
-                if self.is_road(hp):
-                    for r in all_roads['E']:
-                        for p in r:
-                            if self.is_transparent(p):
-                                los.append(p)
-                            else:
-                                # road positions are ordered outward from hp, so stop
-                                # processing when visibility ends
-                                break
-
-            # hunter is looking N
-            if hp.d == 1 or hp.d == -1:
-                # accumulate LOS along this col
-                for r in range(hp.row-1, -1, -1):
-                    bp = BoardPosition(r, hp.col)
-                    if self.is_transparent(bp):
-                        los.append(bp)
-                    else:
-                        break
-                if self.is_road(hp):
-                    for r in all_roads['N']:
-                        for p in r:
-                            if self.is_transparent(p):
-                                los.append(p)
-                            else:
-                                # road positions are ordered outward from hp, so stop
-                                # processing when visibility ends
-                                break
-
-            # hunter is looking W
-            if hp.d == 2 or hp.d == -1:
-                # accumulate LOS along this row
-                for c in range(hp.col-1, -1, -1):
-                    bp = BoardPosition(hp.row, c)
-                    if self.is_transparent(bp):
-                        los.append(bp)
-                    else:
-                        break
-                if self.is_road(hp):
-                    for r in all_roads['W']:
-                        for p in r:
-                            if self.is_transparent(p):
-                                los.append(p)
-                            else:
-                                # road positions are ordered outward from hp, so stop
-                                # processing when visibility ends
-                                break
-
-            # hunter is looking S
-            if hp.d == 3 or hp.d == -1:
-                # accumulate LOS along this col
-                for r in range(hp.row+1, N_ROWS):
-                    bp = BoardPosition(r, hp.col)
-                    if self.is_transparent(bp):
-                        los.append(bp)
-                    else:
-                        break
-                if self.is_road(hp):
-                    for r in all_roads['S']:
-                        for p in r:
-                            if self.is_transparent(p):
-                                los.append(p)
-                            else:
-                                # road positions are ordered outward from hp, so stop
-                                # processing when visibility ends
-                                break
-        return los
-
-    def print(self):
-        for r in range(0,N_ROWS):
-            for c in range(0,N_COLS):
-                print(self.board_cells[r][c],end='')
-            print()
-
-
-# TODO: need a way to flip HIDDEN to SURGE or STEALTH
-class Agent():
-    EQUIP_UNKNOWN=-1
-    EQUIP_HIDDEN=0
-    EQUIP_SURGE=1
-    EQUIP_STEALTH=2
-    EQUIP_FLASH=3
-    EQUIP_SMOKE=4
-    EQUIP_UNIQUE=5
-
-    def  __init__(self,equip_slots=5):
-        self.weight = 1 # number of possible paths this agent represent
-        self.equip_list = [self.EQUIP_UNKNOWN for i in range(equip_slots)] # INVARIANT: list[i] >= list[j] for i <= j
-        self.position_history=[BoardPosition.from_string('N1')] # history[i] is where the agent ended turn i
-        self.turn_history=[[BoardPosition.from_string('N1')]] # history[i] is the list of positions for turn i
-                                                              # INVARIANT:
-                                                              #   turn_history[i][0] == position_history[i-1]
-                                                              #   turn_history[i][-1] == position_history[i]
-
-    def __str__(self):
-        retv='id: '
-
-        retv += '\nequipment:'
-        for e in self.equip_list:
-            retv += ' unknown' if e == Agent.EQUIP_UNKNOWN else (
-                    ' unique'  if e == Agent.EQUIP_UNIQUE else (
-                    ' surge'   if e == Agent.EQUIP_SURGE else (
-                    ' stealth' if e == Agent.EQUIP_STEALTH else (
-                    ' flash'   if e == Agent.EQUIP_FLASH else (
-                    ' smoke'   if e == Agent.EQUIP_SMOKE else 'hidden' )))))
-        retv += '\npos:'
-        for p in self.position_history:
-            retv += ' %s' % p
-        retv += '\nturns:'
-        for t in self.turn_history:
-            for p in t:
-                retv += ' %s' % p
-            retv += ' |'
-        retv += '\n'
-        return retv
-
-    def clone(self,other):
-        self.weight = other.weight
-        self.equip_list = [e for e in other.equip_list]
-        self.position_history = [BoardPosition.clone(p) for p in other.position_history]
-        self.turn_history = [[BoardPosition.clone(p) for p in h] for h in other.turn_history]
-
-    def add_turn(self,turn):
-        self.turn_history.append(turn)
-        self.position_history.append(turn[-1])
-
-    def get_turn(self,idx=-1):
-        return self.turn_history[idx]
-
-    def get_position(self,idx=-1):
-        return self.position_history[idx]
-
-    def num_equip(self,e=EQUIP_UNKNOWN):
-        index = [i for i in range(len(self.equip_list)) if self.equip_list[i] == e]
-        if e==Agent.EQUIP_HIDDEN:
-            index2 = [i for i in range(len(self.equip_list)) if self.equip_list[i] == Agent.EQUIP_SURGE]
-            index.append(index2)
-            index2 = [i for i in range(len(self.equip_list)) if self.equip_list[i] == Agent.EQUIP_STEALTH]
-            index.append(index2)
-        return len(index)
-
-    def set_equip(self,e):
-        # determine where the equipment should go, i.e. the first UNKNOWN spot
-        index = len(self.equip_list) - self.num_equip(Agent.EQUIP_UNKNOWN)
-        # if there's space, and if we're not maxed on this equippment
-        if index < len(self.equip_list) and self.num_equip_possible(e) > 0:
-            self.equip_list[index] = e
-        # keep the list in proper order
-        self.equip_list.sort()
-
-    def has_unknown_equip(self):
-        return self.num_equip(Agent.EQUIP_UNKNOWN) > 0
-
-    # return the number of possible unknown equipment cards of a given type an agent might have
-    # for example, an agent known to have played "stealth field" with three remaining unknown
-    #  equipments can only possibly have one more stealth field
-    # or, an agent cannot have any more smoke grenades if all equipment has been identified
-    def num_equip_possible(self,e):
-        if e == Agent.EQUIP_UNKNOWN:
-            return 0 # this isn't a real equipment type
-        else:
-            # determine known equipment of the given type
-            cnt = self.num_equip(e)
-            max_num = 2
-            if e == Agent.EQUIP_UNIQUE:
-                # there can only be one unique equipment card
-                max_num = 1
-            elif e == Agent.EQUIP_HIDDEN:
-                max_num = 4
-            # number of slots is smaller of total open and open of this equip type
-            return min(max_num - cnt, self.num_equip(Agent.EQUIP_UNKNOWN))
-
-    def unique(self):
-        # need to consider two turns to allow post-cog to work
-        return [self.equip_list, self.position_history[-2:]]
-
-
-def print_moves(new_moves):
-    for idx,p in enumerate(new_moves):
-        print(p,end='')
-        if idx==len(new_moves)-2:
-            print('->',end='')
-        elif idx==len(new_moves)-1:
-            print('')
-        else:
-            print('-',end='')
-
-def print_moves_list(moves_list):
-    for l in range(0, len(moves_list)):
-        print('length %d:' % l)
-        for m in moves_list[l]:
-            print_moves(m)
-
-
-class Sim():
-    AGENT_UNKNOWN=-1
-    AGENT_OTHER=0
-    AGENT_BLUEJAY=1
-
-    def __init__(self, in_file=None, out_file=None):
-        self.board = Board()
-        self.prop_count = 0
-        self.agent_id = self.AGENT_UNKNOWN
-        self.equip_used = 0 # 0: none, 1: apply this propagation, 2: apply during obs and cancel at next prop
-        # self.agent_list[i] is the turn history for agent i
-        # self.agent_list[i][j] is the move sequence for agent i's turn j
-        # self.agent_list[i][j][k] is the kth position of agent i's jth turn
-        self.agent_list=[Agent()]
-        self.mission_pos=[]
-
-        if out_file is not None:
-            self.fdo = open(out_file, 'wt')
-        else:
-            self.fdo = None
-
-        if in_file is not None:
-            self.fdi = open(in_file, 'rt')
-            self.init_from_file()
-
-    def init_from_file(self):
-        for l in self.fdi:
-            t = l.split()
-            if len(t) == 0:
-                break
-            if t[0] == 'propagate':
-                self.propagate()
-            elif t[0] == 'spotted':
-                ap=BoardPosition.from_string('' if t[1] == '??' else t[1])
-                hp=BoardPosition.from_string(t[2])
-                self.spotted_obs(ap, hp)
-            elif t[0] == 'last_seen':
-                ap=BoardPosition.from_string('' if t[1] == '??' else t[1])
-                hp=BoardPosition.from_string(t[2])
-                self.last_seen_obs(ap, hp)
-            elif t[0] == 'motion':
-                cp=BoardPosition.from_string(t[1])
-                self.motion_obs(cp, t[2])
-            elif t[0] == 'sniffed':
-                hp=BoardPosition.from_string(t[1])
-                self.sniffed_obs(hp, t[2] == 'True')
-            elif t[0] == 'mission':
-                mp=BoardPosition.from_string(t[1])
-                self.mission_obs(mp)
-            elif t[0] == 'precog':
-                self.precog_obs()
-            elif t[0] == 'postcog':
-                ap=BoardPosition.from_string(t[1])
-                self.postcog_obs(ap)
-            elif t[0] == 'flash':
-                gp=BoardPosition.from_string(t[1])
-                self.__equip_grenade_obs(gp, Agent.EQUIP_FLASH)
-            elif t[0] == 'smoke':
-                gp=BoardPosition.from_string(t[1])
-                self.__equip_grenade_obs(gp, Agent.EQUIP_SMOKE)
-            elif t[0] == 'unique':
-                self.__equip_unique_obs()
-            elif t[0] == 'hidden':
-                self.__equip_hidden_obs()
-            elif t[0] == 'identity':
-                self.identity_obs(self.AGENT_BLUEJAY if t[1] == 'bluejay' else self.AGENT_OTHER)
-            else:
-                print('unknown command %s' % t[0])
-                break
-
-    def propagate(self):
-        self.prop_count += 1
-        if self.fdo is not None:
-            self.fdo.write('propagate %d\n' % self.prop_count)
-
-        # first, clean up any smoke grenades from last turn
-        if self.board.smokep is not None:
-            self.board.clear_smoke()
-            print('cleared smoke')
-
-        if self.equip_used == 2:
-            self.equip_used = 0
-
-        # we don't actually care about detailed history once the hunter turn is over.
-        # therefore, before propagating we can ignore any differences in how agents moved
-        # between end turn locations and collapse those that have the same end history and
-        # equipment lists
-        #
-        # as long as all observations are processed, all remaining paths are equally likely
-        # for simplicity we keep the history of the first agent to reach a given position with
-        # a given set of equipment
-        unique_list=[]
-        trimmed_agents=[]
-        for agent in self.agent_list:
-            u = agent.unique()
-            try:
-                unique_list.index(u)
-            except:
-                # we don't already have this unique list, so add it and the agent
-                trimmed_agents.append(agent)
-                unique_list.append(u)
-            else:
-                # we've already got it, so increase the weight of the representative agent
-                a = [i for i in trimmed_agents if u == i.unique()]
-                if len(a) > 1:
-                    print('problem!')
-                a[0].weight += 1
-        print('trimmed %d -> %d' % (len(self.agent_list), len(trimmed_agents)))
-        # TODO: unique list is a good place to check for equipment that all agent particles have
-
-        new_agents=[]
-        # we're going to propagate every tracked agent to all the places they could go, each becoming a new agent
-        for agent in trimmed_agents:
-            # propagation starts at the last position in their history
-            start_pos = agent.get_position()
-            # we'll have a list for each possible move sequence length
-            # length 0 consists of staying put
-            n_moves_list = [[[start_pos]]]
-            # num moves can depend on if the agent plays "adrenal surge"
-            max_num_moves = NUM_MOVES_PER_TURN
-            if self.equip_used == 1 and agent.num_equip_possible(Agent.EQUIP_SURGE) > 0:
-                max_num_moves = NUM_MOVES_PER_TURN_SURGE
-            for l in range(1, max_num_moves+1):
-                # initialize the list for this sequence length
-                n_moves_list.append([])
-                # we take every sequence from the previous length and expand by one move
-                for moves in n_moves_list[l-1]:
-                    # grab where the sequence stopped
-                    last_pos = moves[-1]
-                    # compute the neighbors of that position
-                    n = self.board.adjacent(last_pos, only_passable=True)
-                    for j in n:
-                        new_moves=moves+[j]
-                        n_moves_list[l].append(new_moves)
-            # now, all these new moves turn into agent particles with the same shared history
-            for m in range(0, len(n_moves_list)):
-                for t in n_moves_list[m]:
-                    new_agent = Agent()
-                    new_agent.clone(agent)
-                    new_agent.add_turn(t)
-                    if len(t) > NUM_MOVES_PER_TURN+1:
-                        new_agent.set_equip(Agent.EQUIP_SURGE)
-                    new_agents.append(new_agent)
-        self.agent_list = new_agents
-
-        if self.equip_used == 1:
-            self.equip_used = 2
-
-    # ap is the location the agent was spotted (empty if not spotted)
-    # hp is the location of the observant hunter
-    def spotted_obs(self, ap, hp):
-        if self.fdo is not None:
-            self.fdo.write('spotted %s %s\n' % (str(ap), str(hp)))
-        new_list=[]
-        if self.board.contains(ap):
-            print('spotted from %s at %s' % (str(hp), str(ap)))
-            # kepp all agents at ap
-            for a in self.agent_list:
-                if a.get_position() == ap:
-                    new_list.append(a)
-        else:
-            print('not in LOS from %s' % str(hp))
-            # keep all agents that are not in hunter LOS
-            los = self.board.hunter_los(hp)
-            for a in self.agent_list:
-                try:
-                    los.index(a.get_position())
-                except:
-                    new_list.append(a)
-                else:
-                    # if the agent played equipment that could have been "stealth field",
-                    #  keep them if they were in the LOS but never closer than 3 spaces
-                    # also, it's possible they just played "adrenal surge", in which case they
-                    #  can't have played "stealth field"
-                    if self.equip_used == 2 and a.num_equip_possible(Agent.EQUIP_STEALTH) > 0 and len(a.get_turn()) <= NUM_MOVES_PER_TURN+1:
-                        close_pos = [p for p in a.get_turn() if (p in los and p.dist(hp) <= STEALTH_RANGE)]
-                        if len(close_pos) == 0:
-                            a.set_equip(Agent.EQUIP_STEALTH)
-                            new_list.append(a)
-        self.agent_list = new_list
-
-    # ap is the location the agent was last seen (empty if not seen)
-    # hp is the location of the observant hunter
-    def last_seen_obs(self, ap, hp):
-        if self.fdo is not None:
-            self.fdo.write('last_seen %s %s\n' % (str(ap), str(hp)))
-        new_list=[]
-        los = self.board.hunter_los(hp)
-        if self.board.contains(ap):
-            print('last seen from %s at %s' % (str(hp), str(ap)))
-            for a in self.agent_list:
-                #  keep agents that passed through ap and didn't end in ap and weren't visible
-                #  through a later LOS
-                idx = [i for i,v in enumerate(a.get_turn()[:-1]) if v == ap]
-                #  agent passed through ap so they definitely were spotted
-                if len(idx) > 0:
-                    # now for the moves after where the agent last passed through ap, make sure none
-                    #  are in the hunter LOS
-                    idx = idx[-1]
-                    later_los=False
-                    for p in a.get_turn()[idx+1:]:
-                        try:
-                            los.index(p)
-                        except:
-                            pass
-                        else:
-                            later_los = True
-                            break
-                    if not later_los:
-                        new_list.append(a)
-                # if the agent could be bluejay and has not played their unique ability card
-                #  then create a clone of this agent who has played "holo decoy" and keep them
-                #  anyway
-                # TODO: remember that last seen will positively identify the agent!
-                if self.agent_id != self.AGENT_OTHER and a.num_equip_possible(Agent.EQUIP_UNIQUE) > 0:
-                    b = Agent()
-                    b.clone(a)
-                    b.set_equip(Agent.EQUIP_UNIQUE)
-                    new_list.append(b)
-        else:
-            print('not seen crossing LOS of %s' % str(hp))
-            # keep agents that didn't cross LOS, or agents that played equipment that could have
-            #  used "stealth field"
-            for a in self.agent_list:
-                in_los=False
-                for p in a.get_turn():
-                    try:
-                        los.index(p)
-                    except:
-                        pass
-                    else:
-                        in_los=True
-                        break
-                if not in_los:
-                    new_list.append(a)
-                elif self.equip_used == 2 and a.num_equip_possible(Agent.EQUIP_STEALTH) > 0 and len(a.get_turn()) <= NUM_MOVES_PER_TURN+1:
-                    # if the agent played equipment that could have been "stealth field",
-                    #  keep them if they were in the LOS but never closer than 3 spaces
-                    # also, it's possible they just played "adrenal surge", in which case they
-                    #  can't have played "stealth field"
-                    close_pos = [p for p in a.get_turn() if (p in los and p.dist(hp) <= STEALTH_RANGE)]
-                    if len(close_pos) == 0:
-                        a.set_equip(Agent.EQUIP_STEALTH)
-                        new_list.append(a)
-        self.agent_list = new_list
-
-    # mp is the location of the completed mission objective
-    def mission_obs(self, mp):
-        if self.fdo is not None:
-            self.fdo.write('mission %s\n' % str(mp))
-        print('misson %s' % str(mp))
-        self.mission_pos.append(mp)
-        # keep agents that started adjacent to the mission objective
-        new_list=[]
-        # if agent is known to not be bluejay, agent must have started within one space of the objective
-        # otherwise, they could have started within two spaces
-        if self.agent_id == self.AGENT_OTHER:
-            adj = self.board.adjacent(mp, only_passable=True)
-        else:
-            adj = self.board.adjacent(mp,dist=2, only_passable=True)
-        for a in self.agent_list:
-            # try looking for where they started their turn in the positions next to the objective
-            try:
-                adj.index(a.get_turn()[0])
-            except:
-                pass
-            else:
-                new_list.append(a)
-        self.agent_list = new_list
-
-    # cp is the location of the car
-    # d is either the direction motion was detected (e.g. NW, E, etc) or empty string for no motion
-    def motion_obs(self, cp, d):
-        if self.fdo is not None:
-            self.fdo.write('motion %s %s\n' % (str(cp), d))
-        new_list=[]
-        if d == 'none':
-            print('no motion')
-            # keep all agents whose last turn pos list length is less than motion detect thresh
-            for a in self.agent_list:
-                if len(a.get_turn()) < MOTION_DETECT_MOVES + 1:
-                    new_list.append(a)
-        else:
-            print('motion to the %s of %s' % (d, str(cp)))
-            # keep all agents in the given direction and whose last turn pos list length
-            #   is greater than motion detect thresh
-            if d == 'E':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row == cp.row and ap.col > cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'NE':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row < cp.row and ap.col > cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'N':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.col == cp.col and ap.row < cp.row and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'NW':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row < cp.row and ap.col < cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'W':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row == cp.row and ap.col < cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'SW':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row > cp.row and ap.col < cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'S':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.col == cp.col and ap.row > cp.row and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            elif d == 'SE':
-                for a in self.agent_list:
-                    ap = a.get_position()
-                    if ap.row > cp.row and ap.col > cp.col and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1:
-                        new_list.append(a)
-            else:
-                pass
-        self.agent_list = new_list
-
-    # hp is the location of the hunter (beast)
-    # sniffed is true if the agent was detected, false otherwise
-    def sniffed_obs(self, hp, sniffed):
-        if self.fdo is not None:
-            self.fdo.write('sniffed %s %s\n' % (str(hp), 'True' if sniffed else 'False'))
-        new_list=[]
-        if sniffed:
-            print('sniffed near %s' % str(hp))
-            # keep all agents within 4 spaces of hp
-            for a in self.agent_list:
-                ap = a.get_position()
-                if abs(ap.row - hp.row) <= SNIFF_RANGE and abs(ap.col - hp.col) <= SNIFF_RANGE:
-                    new_list.append(a)
-        else:
-            print('not sniffed near %s' % str(hp))
-            # keep all agents not within 4 spaces of hp
-            for a in self.agent_list:
-                ap = a.get_position()
-                if abs(ap.row - hp.row) > SNIFF_RANGE or abs(ap.col - hp.col) > SNIFF_RANGE:
-                    new_list.append(a)
-        self.agent_list = new_list
-
-    def precog_obs(self):
-        if self.fdo is not None:
-            self.fdo.write('precog\n')
-        print('precog')
-        # only keep agents adjacent to any mission objective
-        new_list=[]
-        for a in self.agent_list:
-            # if agent is known to not be bluejay, agent must have ended within one space of the objective
-            # otherwise, they could have ended within two spaces
-            if self.agent_id == self.AGENT_OTHER:
-                adj = self.board.adjacent(a.get_position())
-            else:
-                adj = self.board.adjacent(a.get_position(), dist=2)
-            for p in adj:
-                if self.board.is_objective(p):
-                    new_list.append(a)
-                    break
-        self.agent_list = new_list
-
-    # ap is the location of the agent two turns ago
-    def postcog_obs(self, ap):
-        if self.fdo is not None:
-            self.fdo.write('postcog %s\n' % (ap))
-        print('postcog at %s' % str(ap))
-        new_list=[]
-        # only keep agents who were at ap two turns ago
-        for a in self.agent_list:
-            if a.get_turn(-3)[-1] == ap:
-                new_list.append(a)
-        self.agent_list = new_list
-
-    def __equip_grenade_obs(self, gp, g_type):
-        if g_type == Agent.EQUIP_FLASH:
-            if self.fdo is not None:
-                self.fdo.write('flash %s\n' % (gp))
-            print('flash grenade at %s' % str(gp))
-        elif g_type == Agent.EQUIP_SMOKE:
-            if self.fdo is not None:
-                self.fdo.write('smoke %s\n' % (gp))
-            print('smoke grenade at %s' % str(gp))
-            self.board.place_smoke(gp)
-        new_list=[]
-        # only keep agents that have an unused equipment slot, and were within
-        #  4 spaces of the grenade location at any point during their last turn
-        # also, note the equipment
-        for a in self.agent_list:
-            if a.num_equip_possible(g_type) > 0:
-                for p in a.get_turn():
-                    if abs(p.row - gp.row) <= GRENADE_RANGE and abs(p.col - gp.col) <= GRENADE_RANGE:
-                        a.set_equip(g_type)
-                        new_list.append(a)
-                        break
-        self.agent_list = new_list
-
-    def __equip_unique_obs(self):
-        if self.fdo is not None:
-            self.fdo.write('unique\n')
-        print('agent\'s unique equipment used')
-        # keep agents that have an unused equipment slot and note the unique equipment
-        new_list=[]
-        for a in self.agent_list:
-            if a.num_equip_possible(Agent.EQUIP_UNIQUE) > 0:
-                a.set_equip(Agent.EQUIP_UNIQUE)
-                new_list.append(a)
-        self.agent_list = new_list
-
-    def __equip_hidden_obs(self):
-        if self.fdo is not None:
-            self.fdo.write('hidden\n')
-        print('hidden equipment used')
-        # note that some hidden equipment was used
-        self.equip_used = 1
-        # keep agents that have an unused equipment slot and note in the agent the hidden equipment
-        new_list=[]
-        for a in self.agent_list:
-            if a.num_equip_possible(Agent.EQUIP_HIDDEN) > 0:
-                a.set_equip(Agent.EQUIP_HIDDEN)
-                new_list.append(a)
-        self.agent_list = new_list
-
-    def equip_obs(self, ep, e_type):
-        if e_type == Agent.EQUIP_FLASH or e_type == Agent.EQUIP_SMOKE:
-            self.__equip_grenade_obs(ep, e_type)
-        elif e_type == Agent.EQUIP_UNIQUE:
-            self.__equip_unique_obs()
-        else:
-            self.__equip_hidden_obs()
-
-    def identity_obs(self, ident):
-        if self.fdo is not None:
-            self.fdo.write('identity %s\n' % ('bluejay' if ident ==self.AGENT_BLUEJAY else 'other'))
-        print('id: %s' % ('bluejay' if ident ==self.AGENT_BLUEJAY else 'other'))
-        self.agent_id = ident
+POLL_MS=100 # how often the window checks on the command running in the background
 
 
 class MainWindow(tk.Frame):
-    def __init__(self, in_file=None, out_file=None, master=None):
+    def __init__(self, in_file=None, out_file=None, engine=Sim.ENGINE_PATHS, workers=1, max_particles=None,
+                 resample=Sim.RESAMPLE_SYSTEMATIC, snapshot=None, checkpoint_every=None, undo_bytes=None, flush_every=1,
+                 fsync_every=None, quiet=False, master=None):
         tk.Frame.__init__(self, master)
         self.grid()
 
-        self.sim = Sim(in_file=in_file, out_file=out_file)
+        # kept to start a new simulation on reset
+        self.sim_args = {'engine': engine, 'workers': workers, 'max_particles': max_particles, 'resample': resample,
+                         'undo_bytes': undo_bytes}
+        self.sim = make_sim(in_file=in_file, out_file=out_file, snapshot=snapshot, checkpoint_every=checkpoint_every,
+                            flush_every=flush_every, fsync_every=fsync_every, quiet=quiet, **self.sim_args)
+        # propagation and observations run one at a time in a background thread, in the order
+        #  they were clicked, so the window keeps responding
+        self.jobs=[]
+        self.job = None
+        self.job_progress = None
 
         self.init_ui()
         self.winfo_toplevel().title("Specter Ops Agent Locator")
@@ -955,10 +39,18 @@ class MainWindow(tk.Frame):
         # TODO: it would be nice to show known info, i.e. bluejay or not, used equip
         self.canvas = tk.Canvas(self, width=570,height=800)
         self.canvas.grid(column=0, row=0, rowspan=30)
-        self.board_img = ImageTk.PhotoImage(Image.open("board.png"))
+        self.board_img = ImageTk.PhotoImage(Image.open(os.path.join(DATA_DIR, 'board.png')))
         self.canvas.create_image(0, 0, anchor=tk.NW, image=self.board_img)
         self.prob_grid=[]
         self.inspect_path=[]
+        # the heatmap is a rectangle per cell created once, recoloured when its probability
+        #  changes and hidden while it's zero
+        self.prob=[0] * (N_ROWS*N_COLS)
+        self.prob_cells=[]
+        self.prob_colors=[None] * (N_ROWS*N_COLS)
+        for i in range(N_ROWS*N_COLS):
+            gc=BoardPosition.from_index(i).screen_pos()
+            self.prob_cells.append(self.canvas.create_rectangle(gc[1]-DCOL/2+PROB_RECT_OFFSET,gc[0]-DROW/2+PROB_RECT_OFFSET,gc[1]+DCOL/2-PROB_RECT_OFFSET,gc[0]+DROW/2-PROB_RECT_OFFSET,fill='',width=3,state='hidden'))
 
         entry_row=0
         self.propagate_button = tk.Button(self, text="Propagate", command=self.on_prop_click)
@@ -969,6 +61,20 @@ class MainWindow(tk.Frame):
         self.agent_count.grid(column=2, row=entry_row)
         entry_row += 1
 
+        self.cancel_button = tk.Button(self, text="Cancel", command=self.on_cancel_click, state=tk.DISABLED)
+        self.cancel_button.grid(column=1, row=entry_row)
+        self.progress_text = tk.StringVar()
+        self.progress_text.set('')
+        self.progress_label = tk.Label(self, textvariable=self.progress_text)
+        self.progress_label.grid(column=2, row=entry_row)
+        entry_row += 1
+
+        self.undo_button = tk.Button(self, text="Undo", command=self.on_undo_click)
+        self.undo_button.grid(column=1, row=entry_row)
+        self.redo_button = tk.Button(self, text="Redo", command=self.on_redo_click)
+        self.redo_button.grid(column=2, row=entry_row)
+        entry_row += 1
+
         self.inspect_button = tk.Button(self, text="Inspect", command=self.on_inspect_click)
         self.inspect_button.grid(column=1, row=entry_row)
         self.inspect_entry_text = tk.StringVar()
@@ -1106,6 +212,10 @@ class MainWindow(tk.Frame):
         self.reset_button.grid(column=1, row=entry_row, columnspan=2)
         entry_row += 1
 
+        # these use the sim (or the board's smoke) straight from the window, so they wait for
+        #  the job running on it
+        self.idle_buttons = [self.undo_button, self.redo_button, self.inspect_button, self.los_test_button]
+
         # tooltips
         def ttp_clear(event, self=self, text=''):
             return self.tooltip_text(text)
@@ -1113,6 +223,12 @@ class MainWindow(tk.Frame):
             return self.tooltip_text(text)
         def agent_count_ttp(event, self=self, text='Number of hypothetical agents being tracked.'):
             return self.tooltip_text(text)
+        def cancel_button_ttp(event, self=self, text='Stop the propagation in progress, going back to the agents from before it, and drop any observations clicked since.'):
+            return self.tooltip_text(text)
+        def undo_button_ttp(event, self=self, text='Go back to before the last propagation or observation, taking it out of the log.'):
+            return self.tooltip_text(text)
+        def redo_button_ttp(event, self=self, text='Put back the last propagation or observation undone, if nothing has been clicked since.'):
+            return self.tooltip_text(text)
         def inspect_ttp(event, self=self, text='Plot the route of an agent, indexed by the number in the entry box.'):
             return self.tooltip_text(text)
         def bluejay_button_ttp(event, self=self, text='If the agent is positively identified, click the true/false button depending on if the agent is Bluejay or not. Do this before providing spotted or last seen observations.'):
@@ -1147,6 +263,9 @@ class MainWindow(tk.Frame):
         self.agent_count.bind(         '<Enter>', agent_count_ttp)
         self.inspect_button.bind(      '<Enter>', inspect_ttp)
         self.inspect_entry.bind(       '<Enter>', inspect_ttp)
+        self.cancel_button.bind(       '<Enter>', cancel_button_ttp)
+        self.undo_button.bind(         '<Enter>', undo_button_ttp)
+        self.redo_button.bind(         '<Enter>', redo_button_ttp)
         self.bluejayt_button.bind(     '<Enter>', bluejay_button_ttp)
         self.bluejayf_button.bind(     '<Enter>', bluejay_button_ttp)
         self.spotted_button.bind(      '<Enter>', spotted_button_ttp)
@@ -1176,6 +295,9 @@ class MainWindow(tk.Frame):
         self.agent_count.bind(         '<Leave>', ttp_clear)
         self.inspect_button.bind(      '<Leave>', ttp_clear)
         self.inspect_entry.bind(       '<Leave>', ttp_clear)
+        self.cancel_button.bind(       '<Leave>', ttp_clear)
+        self.undo_button.bind(         '<Leave>', ttp_clear)
+        self.redo_button.bind(         '<Leave>', ttp_clear)
         self.bluejayt_button.bind(     '<Leave>', ttp_clear)
         self.bluejayf_button.bind(     '<Leave>', ttp_clear)
         self.spotted_button.bind(      '<Leave>', ttp_clear)
@@ -1203,7 +325,8 @@ class MainWindow(tk.Frame):
         self.extra_entry.bind(         '<Leave>', ttp_clear)
 
     def draw_probability(self):
-        self.agent_count_text.set('Agents: %d' % len(self.sim.agent_list))
+        num_agent = self.sim.num_particles()
+        self.agent_count_text.set('Agents: %d' % num_agent)
         for i in self.inspect_path:
             self.canvas.delete(i)
         for i in self.prob_grid:
@@ -1214,27 +337,26 @@ class MainWindow(tk.Frame):
                                                              sp[1]+DCOL/2-PROB_RECT_OFFSET,sp[0]-DROW/2+PROB_RECT_OFFSET,
                                                              sp[1],sp[0]+DROW/2-PROB_RECT_OFFSET,
                                                              fill='',outline='red',width=3))
-        prob_board = Board(init_empty = True)
-        num_agent = len(self.sim.agent_list)
-        all_weights = [a.weight for a in self.sim.agent_list]
-        total_weight = sum(all_weights) * 1.0
+        total_weight = self.sim.total_weight() * 1.0
         # TODO: maybe print this after each propagate/update step
         print('total particles: %d\taverage weight: %.1f' % (num_agent, total_weight / num_agent if num_agent > 0 else 0))
-        for agent in self.sim.agent_list:
-            pos = agent.get_position()
-            tmp = prob_board.get(pos)
-            prob_board.set(pos, tmp + agent.weight / total_weight)
-        for r in range(0,N_ROWS):
-            for c in range(0,N_COLS):
-                p = prob_board.board_cells[r][c]
-                if p > 0:
-                    gc=BoardPosition(r,c).screen_pos()
-                    b = int(p*2550)
-                    b = b if b < 255 else 255
-                    g = int((p-0.1)/0.9*255)
-                    g = g if g > 0 else 0
-                    color='#00%02x%02x' % (g, b)
-                    self.prob_grid.append(self.canvas.create_rectangle(gc[1]-DCOL/2+PROB_RECT_OFFSET,gc[0]-DROW/2+PROB_RECT_OFFSET,gc[1]+DCOL/2-PROB_RECT_OFFSET,gc[0]+DROW/2-PROB_RECT_OFFSET,fill='',outline=color,width=3))
+        self.sim.cell_probabilities(self.prob)
+        for i in range(N_ROWS*N_COLS):
+            p = self.prob[i]
+            color = None
+            if p > 0:
+                b = int(p*2550)
+                b = b if b < 255 else 255
+                g = int((p-0.1)/0.9*255)
+                g = g if g > 0 else 0
+                color='#00%02x%02x' % (g, b)
+            if color == self.prob_colors[i]:
+                continue
+            self.prob_colors[i] = color
+            if color is None:
+                self.canvas.itemconfig(self.prob_cells[i], state='hidden')
+            else:
+                self.canvas.itemconfig(self.prob_cells[i], outline=color, state='normal')
 
     def draw_test(self):
         for r in range(0,N_ROWS):
@@ -1249,9 +371,71 @@ class MainWindow(tk.Frame):
     def main(self):
         self.root.mainloop()
 
-    def on_prop_click(self):
-        self.sim.propagate()
+    # queues fn(*args) to run in the background after the commands already clicked
+    def run_job(self, name, fn, *args):
+        self.jobs.append((name, fn, args))
+        if self.job is None:
+            self.start_job()
+
+    def start_job(self):
+        name, fn, args = self.jobs.pop(0)
+        self.job_name = name
+        self.job_progress = None
+        self.job_error = None
+        self.sim.progress = self.on_progress
+        self.job = threading.Thread(target=self.job_thread, args=(fn, args), daemon=True)
+        self.job.start()
+        self.cancel_button.config(state=tk.NORMAL if name == 'propagate' else tk.DISABLED)
+        for b in self.idle_buttons:
+            b.config(state=tk.DISABLED)
+        self.progress_text.set('%s...' % name)
+        self.after(POLL_MS, self.poll_job)
+
+    def job_thread(self, fn, args):
+        try:
+            fn(*args)
+        except PropagationCancelled:
+            pass
+        except Exception as e:
+            self.job_error = e
+
+    # runs in the background thread, so only keeps the numbers for poll_job to show
+    def on_progress(self, done, total):
+        self.job_progress = (done, total)
+
+    def poll_job(self):
+        if self.job.is_alive():
+            if self.job_progress is not None:
+                self.progress_text.set('%s: %d / %d agents' % ((self.job_name,) + self.job_progress))
+            self.after(POLL_MS, self.poll_job)
+            return
+        self.job = None
+        if self.job_error is not None:
+            traceback.print_exception(type(self.job_error), self.job_error, self.job_error.__traceback__)
         self.draw_probability()
+        if len(self.jobs) > 0:
+            self.start_job()
+        else:
+            self.cancel_button.config(state=tk.DISABLED)
+            for b in self.idle_buttons:
+                b.config(state=tk.NORMAL)
+            self.progress_text.set('')
+
+    def on_cancel_click(self):
+        if self.job is None:
+            return
+        # later observations were for the turn being cancelled
+        self.jobs=[]
+        self.sim.cancel()
+
+    def on_undo_click(self):
+        self.run_job('undo', self.sim.undo)
+
+    def on_redo_click(self):
+        self.run_job('redo', self.sim.redo)
+
+    def on_prop_click(self):
+        self.run_job('propagate', self.sim.propagate)
 
     def on_inspect_click(self):
         if len(self.inspect_entry.get()) == 0:
@@ -1263,13 +447,18 @@ class MainWindow(tk.Frame):
         except:
             return
 
-        if index < 0 or index >= len(self.sim.agent_list):
+        # the belief engine keeps no histories to draw
+        if not hasattr(self.sim, 'agent_list') or index < 0 or index >= len(self.sim.agent_list):
             return
 
         for i in self.inspect_path:
             self.canvas.delete(i)
         for i,h in enumerate(self.sim.agent_list[index].turn_history):
+            # for a reachability turn, draw the first of its move sequences
+            if isinstance(h, ReachTurn):
+                h = h.paths()[0]
             for j,p in enumerate(h):
+                p=BoardPosition.from_index(p)
                 this_p=p.screen_pos()
                 if j == len(h)-1:
                     color = 'red'
@@ -1290,52 +479,39 @@ class MainWindow(tk.Frame):
 
     def on_spotted_click(self):
         ap=BoardPosition.from_string(self.agent_pos_entry_text.get())
-        hp=BoardPosition()
-        for p in self.hunter_pos_entry_text.get().split():
-            hp.set(p)
-            self.sim.spotted_obs(ap, hp)
-        self.draw_probability()
+        batch = [('spotted', ap, BoardPosition.from_string(p)) for p in self.hunter_pos_entry_text.get().split()]
+        self.run_job('spotted', self.sim.apply_observations, batch)
 
     def on_last_seen_click(self):
         ap=BoardPosition.from_string(self.agent_pos_entry_text.get())
-        hp=BoardPosition()
-        for p in self.hunter_pos_entry_text.get().split():
-            hp.set(p)
-            self.sim.last_seen_obs(ap, hp)
-        self.draw_probability()
+        batch = [('last_seen', ap, BoardPosition.from_string(p)) for p in self.hunter_pos_entry_text.get().split()]
+        self.run_job('last seen', self.sim.apply_observations, batch)
 
     def on_mission_click(self):
         mp=BoardPosition.from_string(self.agent_pos_entry_text.get())
-        self.sim.mission_obs(mp)
-        self.draw_probability()
+        self.run_job('mission', self.sim.mission_obs, mp)
 
     def on_motion_click(self, mot):
         cp=BoardPosition.from_string(self.hunter_pos_entry_text.get())
-        self.sim.motion_obs(cp, 'none' if mot == '' else mot)
-        self.draw_probability()
+        self.run_job('motion', self.sim.motion_obs, cp, 'none' if mot == '' else mot)
 
     def on_sniffed_click(self, res):
         hp=BoardPosition.from_string(self.hunter_pos_entry_text.get())
-        self.sim.sniffed_obs(hp, res)
-        self.draw_probability()
+        self.run_job('sniffed', self.sim.sniffed_obs, hp, res)
 
     def on_precog_click(self):
-        self.sim.precog_obs()
-        self.draw_probability()
+        self.run_job('precog', self.sim.precog_obs)
 
     def on_postcog_click(self):
         ap=BoardPosition.from_string(self.agent_pos_entry_text.get())
-        self.sim.postcog_obs(ap)
-        self.draw_probability()
+        self.run_job('postcog', self.sim.postcog_obs, ap)
 
     def on_equip_click(self, g_type):
         ap=BoardPosition.from_string(self.agent_pos_entry_text.get())
-        self.sim.equip_obs(ap, g_type)
-        self.draw_probability()
+        self.run_job('equipment', self.sim.equip_obs, ap, g_type)
 
     def on_bluejay_click(self, res):
-        self.sim.identity_obs(Sim.AGENT_BLUEJAY if res else Sim.AGENT_OTHER)
-        self.draw_probability()
+        self.run_job('identity', self.sim.identity_obs, Sim.AGENT_BLUEJAY if res else Sim.AGENT_OTHER)
 
     def on_los_test_click(self):
         for i in self.inspect_path:
@@ -1357,7 +533,18 @@ class MainWindow(tk.Frame):
                                                          outline='purple'))
 
     def on_reset_click(self):
-        self.sim = Sim()
+        # anything still running finishes on the old sim, and is then forgotten
+        self.on_cancel_click()
+        self.reset_sim()
+
+    # the old sim is only closed once its job has stopped, as closing syncs the log the job
+    #  may still be writing
+    def reset_sim(self):
+        if self.job is not None:
+            self.after(POLL_MS, self.reset_sim)
+            return
+        self.sim.close()
+        self.sim = make_sim(**self.sim_args)
         self.draw_probability()
 
     def tooltip_text(self, text):
@@ -1368,12 +555,35 @@ class MainWindow(tk.Frame):
 def main(argv):
     parser = argparse.ArgumentParser(description='Specter ops agent location modelling')
     parser.add_argument( '--input',  help='Initialize state based on saved log file', default=None )
-    parser.add_argument( '--output', help='Log user input to text file',              default=None )
+    parser.add_argument( '--output', help='Log user input to a file, one JSON record per line (can be --input, to carry on with it)',
+                         default=None )
+    parser.add_argument( '--engine', help='Propagation engine: every move sequence (paths), reachability classes (reach) or merged states without histories (belief, needs numpy)',
+                         choices=[Sim.ENGINE_PATHS, Sim.ENGINE_REACH, Sim.ENGINE_BELIEF], default=Sim.ENGINE_PATHS )
+    parser.add_argument( '--workers', help='Number of processes to propagate with',    default=1, type=int )
+    parser.add_argument( '--max-particles', help='Resample down to this many agents after propagating (default: keep all)',
+                         default=None, type=int )
+    parser.add_argument( '--resample', help='How to pick the agents kept by --max-particles',
+                         choices=[Sim.RESAMPLE_SYSTEMATIC, Sim.RESAMPLE_STRATIFIED], default=Sim.RESAMPLE_SYSTEMATIC )
+    parser.add_argument( '--snapshot', help='Start from a snapshot, then read only the rest of --input', default=None )
+    parser.add_argument( '--checkpoint-every', help='Save a snapshot next to --output every this many propagations',
+                         default=None, type=int )
+    parser.add_argument( '--undo-mb', help='Memory to keep for undoing propagations and observations, in MB (0: no undo)',
+                         default=256, type=int )
+    parser.add_argument( '--flush-every', help='Write the --output log to the file every this many commands',
+                         default=1, type=int )
+    parser.add_argument( '--fsync-every', help='Sync the --output log to the disk every this many commands (default: only on exit)',
+                         default=None, type=int )
+    parser.add_argument( '--quiet',  help='Print nothing while reading --input', action='store_true' )
 
     main_args = parser.parse_args()
 
-    app = MainWindow(in_file=main_args.input, out_file=main_args.output)
+    app = MainWindow(in_file=main_args.input, out_file=main_args.output, engine=main_args.engine, workers=main_args.workers,
+                     max_particles=main_args.max_particles, resample=main_args.resample, snapshot=main_args.snapshot,
+                     checkpoint_every=main_args.checkpoint_every,
+                     undo_bytes=main_args.undo_mb * 1024 * 1024 if main_args.undo_mb > 0 else None,
+                     flush_every=main_args.flush_every, fsync_every=main_args.fsync_every, quiet=main_args.quiet)
     app.mainloop()
+    app.sim.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+import sys
+import os
+import argparse
+import contextlib
+import csv
+import json
+import pstats
+import time
+from specter_sim import *
+
+
+# replays a log file written with --output, returning a dict with the final posterior (as a
+#  list of rows of cell probabilities), the number of particles and the time taken by each
+#  command
+#
+# with an Instrument, each command also gets the weights and memory from its record. with
+#  max_particles, the estimated error of each resampling is included
+#
+# with lazy, the particles are only counted once they've been made, and making the last
+#  turn's agents is timed as a final 'materialize' command
+#
+# with batch, the observations between propagations go to Sim.apply_observations together,
+#  timed as one 'batch' command at the line of the first
+def replay(log_file, engine=Sim.ENGINE_PATHS, workers=1, instrument=None, max_particles=None,
+           resample=Sim.RESAMPLE_SYSTEMATIC, lazy=False, batch=False):
+    kwargs = {'lazy': True} if lazy else {}
+    sim = make_sim(engine=engine, workers=workers, instrument=instrument, max_particles=max_particles, resample=resample,
+                   **kwargs)
+    commands=[]
+    def run(line_num, name, fn, *args):
+        start = time.perf_counter()
+        fn(*args)
+        commands.append({'line': line_num, 'command': name, 'seconds': time.perf_counter() - start,
+                         'particles': None if sim.streaming() else sim.num_particles()})
+        if instrument is not None and len(instrument.records) > 0:
+            record = instrument.records[-1]
+            for k in ('weight_in', 'weight_out', 'blocks', 'bytes', 'peak_bytes'):
+                if k in record:
+                    commands[-1][k] = record[k]
+    observations=[]
+    with open(log_file, 'rt') as fd:
+        for line_num, t in read_log(fd):
+            c = sim.parse_command(t)
+            if c is None:
+                print('unknown command %s' % t[0])
+                break
+            if batch and c[0] != 'propagate':
+                if len(observations) == 0:
+                    batch_line = line_num
+                observations.append(c)
+                continue
+            if len(observations) > 0:
+                run(batch_line, 'batch', sim.apply_observations, observations)
+                observations=[]
+            run(line_num, t[0], sim.run_command, t)
+    if len(observations) > 0:
+        run(batch_line, 'batch', sim.apply_observations, observations)
+    if sim.streaming():
+        start = time.perf_counter()
+        sim.materialize()
+        commands.append({'line': None, 'command': 'materialize', 'seconds': time.perf_counter() - start,
+                         'particles': sim.num_particles()})
+    return {'log': log_file,
+            'particles': sim.num_particles(),
+            'total_weight': sim.total_weight(),
+            'commands': commands,
+            'resampling': [{'ess': ess, 'total_variation': tv} for ess, tv in sim.resample_errors],
+            'posterior': sim.posterior()}
+
+
+# one row per particle count, command, resampling estimate and occupied cell
+def write_csv(results, fd):
+    writer = csv.writer(fd)
+    writer.writerow(['log', 'record', 'line', 'name', 'value'])
+    for res in results:
+        writer.writerow([res['log'], 'particles', '', '', res['particles']])
+        for c in res['commands']:
+            writer.writerow([res['log'], 'command', c['line'], c['command'], '%.6f' % c['seconds']])
+        for i, r in enumerate(res['resampling']):
+            writer.writerow([res['log'], 'resampling', i, 'ess', r['ess']])
+            writer.writerow([res['log'], 'resampling', i, 'total_variation', r['total_variation']])
+        for r in range(N_ROWS):
+            for c in range(N_COLS):
+                p = res['posterior'][r][c]
+                if p > 0:
+                    writer.writerow([res['log'], 'posterior', '', str(BoardPosition(r, c)), p])
+
+
+# prints the functions taking the most time in each kind of command
+def print_profiles(records, fd, limit=10):
+    by_command={}
+    for r in records:
+        if 'profile' in r:
+            by_command.setdefault(r['command'], []).append(r['profile'])
+    for name, profiles in by_command.items():
+        print('\n%s (%d calls)' % (name, len(profiles)), file=fd)
+        stats = pstats.Stats(*profiles, stream=fd)
+        stats.sort_stats('cumulative').print_stats(limit)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay specter ops logs without the GUI')
+    parser.add_argument( 'logs',      help='Log files saved with --output', nargs='+' )
+    parser.add_argument( '--format',  help='Output format',                  choices=['json', 'csv'], default='json' )
+    parser.add_argument( '--output',  help='Write results here instead of stdout', default=None )
+    parser.add_argument( '--engine',  help='Propagation engine: every move sequence (paths), reachability classes (reach) or merged states without histories (belief, needs numpy)',
+                         choices=[Sim.ENGINE_PATHS, Sim.ENGINE_REACH, Sim.ENGINE_BELIEF], default=Sim.ENGINE_PATHS )
+    parser.add_argument( '--workers', help='Number of processes to propagate with', default=1, type=int )
+    parser.add_argument( '--max-particles', help='Resample down to this many agents after propagating (default: keep all)',
+                         default=None, type=int )
+    parser.add_argument( '--resample', help='How to pick the agents kept by --max-particles',
+                         choices=[Sim.RESAMPLE_SYSTEMATIC, Sim.RESAMPLE_STRATIFIED], default=Sim.RESAMPLE_SYSTEMATIC )
+    parser.add_argument( '--lazy',    help='Make the agents of each propagation only once the observations that follow can filter them',
+                         action='store_true' )
+    parser.add_argument( '--batch',   help='Apply the observations between propagations together', action='store_true' )
+    parser.add_argument( '--profile', help='Profile each command and print where the time goes to stderr', action='store_true' )
+    parser.add_argument( '--trace-memory', help='Add the bytes allocated by each command (slow)', action='store_true' )
+    parser.add_argument( '--quiet',   help="Drop the simulation's progress messages instead of printing them to stderr",
+                         action='store_true' )
+
+    main_args = parser.parse_args(argv)
+
+    results=[]
+    for log_file in main_args.logs:
+        instrument = None
+        if main_args.profile or main_args.trace_memory:
+            instrument = Instrument(profile=main_args.profile, trace_memory=main_args.trace_memory)
+        # the simulation's progress messages go to stderr so they don't mix with the results
+        with open(os.devnull, 'wt') if main_args.quiet else contextlib.nullcontext(sys.stderr) as out:
+            with contextlib.redirect_stdout(out):
+                results.append(replay(log_file, engine=main_args.engine, workers=main_args.workers, instrument=instrument,
+                                      max_particles=main_args.max_particles, resample=main_args.resample,
+                                      lazy=main_args.lazy, batch=main_args.batch))
+        if main_args.profile:
+            print_profiles(instrument.records, sys.stderr)
+
+    fd = open(main_args.output, 'wt', newline='') if main_args.output is not None else sys.stdout
+    if main_args.format == 'csv':
+        write_csv(results, fd)
+    else:
+        json.dump(results, fd, indent=1)
+        fd.write('\n')
+    if fd is not sys.stdout:
+        fd.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,3054 @@
+import sys
+import os
+import array
+import collections
+import contextlib
+import copy
+import cProfile
+import csv
+import functools
+import json
+import math
+import multiprocessing
+import random
+import shutil
+import struct
+import time
+import tracemalloc
+import zlib
+try:
+    import numpy as np
+except ImportError:
+    np = None # observation filters fall back to looping over agents
+
+
+N_ROWS=32
+N_COLS=23
+FIRST_ROW=1
+FIRST_COL=ord('A')
+ROWS=[118, 747]
+DROW=(ROWS[1]-ROWS[0])/N_ROWS
+COLS=[26, 480]
+DCOL=(COLS[1]-COLS[0])/N_COLS
+N_TURNS=40
+TURNS_COL=538
+TURNS_ROW=[40, 721]
+DTURN=(TURNS_ROW[1]-TURNS_ROW[0])/N_TURNS
+PROB_RECT_OFFSET=2
+
+NUM_MOVES_PER_TURN=4
+NUM_MOVES_PER_TURN_SURGE=6
+MOTION_DETECT_MOVES=3
+SNIFF_RANGE=4
+GRENADE_RANGE=4
+STEALTH_RANGE=2
+
+ROAD='.'
+PATH=' '
+WALL='#'
+SMOKE_GRENADE='*'
+
+# motion sensor directions as the sign of the row/col offset from the car
+MOTION_DIRECTIONS={'E':(0,1), 'NE':(-1,1), 'N':(-1,0), 'NW':(-1,-1), 'W':(0,-1), 'SW':(1,-1), 'S':(1,0), 'SE':(1,1)}
+
+# the board (and its image) are read from next to this file, wherever it's run from
+DATA_DIR=os.path.dirname(os.path.abspath(__file__))
+BOARD_FILE=os.path.join(DATA_DIR, 'board.csv')
+
+
+
+class BoardPosition():
+    __slots__ = ('row', 'col', 'd')
+
+    D_LOOKUP=['E','N','W','S']
+
+    @staticmethod
+    def str2rcd(index):
+        if len(index) == 0:
+            c = -1
+            r = -1
+            d = -1
+        else:
+            c = ord(index[0].upper()) - FIRST_COL
+            # handle if direction is specified in string
+            try:
+                d = BoardPosition.D_LOOKUP.index(index[-1].upper())
+            except:
+                d = -1
+                r = int(index[1:]) - FIRST_ROW
+            else:
+                r = int(index[1:-1]) - FIRST_ROW
+        return r,c,d
+
+    def  __init__(self, r=-1, c=-1, d=-1):
+        self.row = r
+        self.col = c
+        self.d   = d
+
+    @classmethod
+    def from_string(cls, index):
+        r,c,d = BoardPosition.str2rcd(index)
+        return BoardPosition(r,c,d)
+
+    # positions can also be encoded as a single cell index, row*N_COLS+col, which is also the
+    #  bit used for the position in a board bitmask
+    @classmethod
+    def from_index(cls, idx):
+        return BoardPosition(idx // N_COLS, idx % N_COLS)
+
+    def index(self):
+        return self.row * N_COLS + self.col
+
+    @classmethod
+    def clone(cls, other):
+        r = other.row
+        c = other.col
+        d = other.d
+        return BoardPosition(r,c,d)
+
+    def __str__(self):
+        if self.on_board():
+            return chr(self.col + FIRST_COL) + str(self.row + FIRST_ROW) + ('' if self.d == -1 else self.D_LOOKUP[self.d])
+        else:
+            return "??"
+
+    def __eq__(self,rhs):
+        return self.row == rhs.row and self.col == rhs.col
+
+    # note: this ordering isn't correct in the strictest sense, but for positions in the same
+    #  row/col (the intended use case), it works fine
+    def __le__(self,rhs):
+        return (self.row <= rhs.row and self.col <= rhs.col)
+
+    def __lt__(self,rhs):
+        return self.__le__(rhs) and not self.__eq__(rhs)
+
+    def __ge__(self,rhs):
+        return (self.row >= rhs.row and self.col >= rhs.col)
+
+    def __gt__(self,rhs):
+        return self.__ge__(rhs) and not self.__eq__(rhs)
+
+    def set(self, index):
+        r,c,d = BoardPosition.str2rcd(index)
+        self.row = r
+        self.col = c
+        self.d   = d
+
+    def on_board(self):
+        return self.col >=0 and self.col < N_COLS and self.row >= 0 and self.row < N_ROWS
+
+    def screen_pos(self):
+        if self.on_board():
+            y=self.row*DROW+ROWS[0]
+            x=self.col*DCOL+COLS[0]
+            return y,x
+        else:
+            return 0,0
+
+    # return true if self is east of rhs
+    def east_of(self,rhs):
+        return self.col > rhs.col
+
+    # return true if self is west of rhs
+    def west_of(self,rhs):
+        return self.col < rhs.col
+
+    # return true if self is north of rhs
+    def north_of(self,rhs):
+        return self.row < rhs.row
+
+    # return true if self is south of rhs
+    def south_of(self,rhs):
+        return self.row > rhs.row
+
+    # return the "distance" between two positions, which is the max of
+    #  the row and column differences
+    def dist(self,other):
+        return max([abs(self.row - other.row), abs(self.col - other.col)])
+
+
+# a straight run of road at least three cells long, and the cells beside it in the lane it's
+#  paired with (roads are two lanes wide), which a hunter on the road sees along
+class RoadSegment():
+    __slots__ = ('axis', 'cells', 'lane')
+
+    def __init__(self, axis, cells, lane):
+        self.axis = axis   # 'EW' or 'NS'
+        self.cells = cells # cell indices along the road, W to E or N to S
+        self.lane = lane   # cell indices beside them in the paired lane, in the same order. empty if it's off the board
+
+    @property
+    def termini(self):
+        return self.cells[0], self.cells[-1]
+
+    # returns the segments of road in rows (tuples of cell values, see BoardGeometry)
+    #
+    # the paired lane is on the row above (or the column to the west) if both its ends are
+    #  road there, otherwise on the row below (or column to the east), which isn't checked
+    @staticmethod
+    def extract(rows):
+        segments=[]
+        def is_road(r, c):
+            return r >= 0 and r < N_ROWS and c >= 0 and c < N_COLS and rows[r][c] == ROAD
+        for axis, n_lines, n_along in (('EW', N_ROWS, N_COLS), ('NS', N_COLS, N_ROWS)):
+            # (row, col) of the cell at position k along line j
+            cell = (lambda j, k: (j, k)) if axis == 'EW' else (lambda j, k: (k, j))
+            for j in range(n_lines):
+                k = 0
+                while k < n_along:
+                    if not is_road(*cell(j, k)):
+                        k += 1
+                        continue
+                    first = k
+                    while k+1 < n_along and is_road(*cell(j, k+1)):
+                        k += 1
+                    last = k
+                    k += 1
+                    if last - first <= 1:
+                        continue
+                    other = j - 1
+                    if not (is_road(*cell(other, first)) and is_road(*cell(other, last))):
+                        other = j + 1
+                    cells = tuple(r*N_COLS + c for r, c in (cell(j, i) for i in range(first, last+1)))
+                    lane=()
+                    if other < n_lines:
+                        lane = tuple(r*N_COLS + c for r, c in (cell(other, i) for i in range(first, last+1)))
+                    segments.append(RoadSegment(axis, cells, lane))
+        return segments
+
+    # returns the table for Board.road_lanes from the segments
+    @staticmethod
+    def lane_table(segments):
+        table = [((), ())] * (N_ROWS*N_COLS*4)
+        for seg in segments:
+            # E and S are along the segment, W and N back along it
+            ahead, back = (0, 2) if seg.axis == 'EW' else (3, 1)
+            for k, i in enumerate(seg.cells):
+                table[i*4 + ahead] = (seg.cells[k+1:], seg.lane[k+1:])
+                table[i*4 + back] = (seg.cells[k-1::-1] if k > 0 else (), seg.lane[k-1::-1] if k > 0 else ())
+        return tuple(table)
+
+
+# what a Board works out from its file before any smoke is placed: the cells, the passable
+#  neighbors of each cell, the masks of each type of cell, the road segments and the LOS of
+#  every cell and facing. it's never modified, so every board of the same file shares one, including
+#  those in propagation workers (which inherit it)
+#
+# compiling takes ~100ms, mostly the LOS, so the result is also kept in a Snapshot next to
+#  the file (board.cache for board.csv). the cache notes a crc32 of the file it was compiled
+#  from and one of its own sections, and is rebuilt when either doesn't match
+class BoardGeometry():
+    VERSION=2
+    SECTIONS=('CELS', 'NBRO', 'NBRS', 'MASK', 'LOSM') # those the cache's checksum covers
+    loaded={} # by path, for this process
+
+    def __init__(self, rows, neighbors, cell_masks, los_table, source):
+        self.rows = rows             # tuple of rows, each a tuple of the cell values
+        self.neighbors = neighbors   # see Board.passable_neighbors
+        self.cell_masks = cell_masks # see Board.cell_mask
+        self.los_table = los_table   # see Board.hunter_los_mask
+        self.source = source         # (size, modification time, crc32) of the file compiled
+        # found again from the cells when read from the cache, it's quick
+        self.road_segments = RoadSegment.extract(rows)
+        self.road_table = RoadSegment.lane_table(self.road_segments) # see Board.road_lanes
+
+    # returns the geometry for the board file at path, compiling it only if neither this
+    #  process nor the cache file has it for the file as it is now
+    @classmethod
+    def load(cls, path=BOARD_FILE):
+        with open(path, 'rb') as fd:
+            st = os.fstat(fd.fileno())
+            source = (st.st_size, st.st_mtime_ns, zlib.crc32(fd.read()))
+        geometry = cls.loaded.get(path)
+        if geometry is None or geometry.source != source:
+            cache = os.path.splitext(path)[0] + '.cache'
+            geometry = None
+            try:
+                geometry = cls.read(cache, source)
+            except (OSError, ValueError, KeyError, TypeError, struct.error):
+                pass # missing, unreadable, corrupt or from an older version
+            if geometry is None:
+                geometry = cls.compile(path, source)
+                try:
+                    geometry.write(cache)
+                except OSError:
+                    pass # e.g. a read only install, which just compiles every time
+            cls.loaded[path] = geometry
+        return geometry
+
+    @classmethod
+    def compile(cls, path, source):
+        board = Board(init_empty=True)
+        with open(path, 'rt') as fd:
+            board_reader = csv.reader(fd)
+            r = 0
+            for row in board_reader:
+                for c,val in enumerate(row):
+                    board.board_cells[r][c] = val
+                    board.backup[r][c] = val
+                r += 1
+        board.hunter_los_mask(BoardPosition(0, 0))
+        board.cell_mask('passable')
+        return cls(tuple(tuple(row) for row in board.backup), tuple(board.passable_neighbors()), board.cell_masks,
+                   tuple(board.los_table), source)
+
+    # the crc32 of the sections the cache's checksum covers, in order
+    @classmethod
+    def checksum(cls, snap):
+        crc = 0
+        for tag in cls.SECTIONS:
+            crc = zlib.crc32(snap.get(tag).tobytes(), crc)
+        return crc
+
+    # returns the geometry in a cache file, or None if it's for another version of the source.
+    #  raises ValueError if the cache is damaged
+    @classmethod
+    def read(cls, path, source):
+        snap = Snapshot.read(path)
+        version, crc, checksum = snap.get('BGEO')
+        if version != cls.VERSION or crc != source[2]:
+            return None
+        if checksum != cls.checksum(snap):
+            raise ValueError('%s is damaged' % path)
+        cells = snap.get('CELS').tobytes().decode().split('\n')
+        offsets = snap.get('NBRO')
+        nbrs = snap.get('NBRS')
+        masks = snap.get_masks('MASK')
+        los_table = snap.get_masks('LOSM')
+        if (len(cells) != N_ROWS*N_COLS or len(offsets) != N_ROWS*N_COLS+1 or offsets[0] != 0 or
+                offsets[-1] != len(nbrs) or any(offsets[i] > offsets[i+1] for i in range(N_ROWS*N_COLS)) or
+                any(i < 0 or i >= N_ROWS*N_COLS for i in nbrs) or
+                len(masks) != len(Board.CELL_KINDS) or len(los_table) != N_ROWS*N_COLS*5):
+            raise ValueError('%s does not hold a whole board' % path)
+        rows = tuple(tuple(cells[r*N_COLS:(r+1)*N_COLS]) for r in range(N_ROWS))
+        neighbors = tuple(tuple(nbrs[offsets[i]:offsets[i+1]]) for i in range(N_ROWS*N_COLS))
+        cell_masks = dict(zip(Board.CELL_KINDS, masks))
+        return cls(rows, neighbors, cell_masks, tuple(los_table), source)
+
+    def write(self, path):
+        snap = Snapshot()
+        snap.add('CELS', 'B', '\n'.join(v for row in self.rows for v in row).encode())
+        offsets=[0]
+        for n in self.neighbors:
+            offsets.append(offsets[-1] + len(n))
+        snap.add('NBRO', 'i', offsets)
+        snap.add('NBRS', 'h', [i for n in self.neighbors for i in n])
+        snap.add_masks('MASK', [self.cell_masks[k] for k in Board.CELL_KINDS])
+        snap.add_masks('LOSM', self.los_table)
+        snap.add('BGEO', 'q', (self.VERSION, self.source[2], self.checksum(snap)))
+        snap.write(path)
+
+
+class Board():
+    # the walk tables cache holds at most this many turns, about 25MB per 100000 with the
+    #  store columns
+    WALK_CACHE_TURNS=500000
+    CELL_KINDS=('passable', 'transparent', 'road', 'objective') # see cell_mask
+
+    def __init__(self,init_empty=False,path=BOARD_FILE):
+        self.smokep = None
+        self.neighbors = None
+        self.road_table = None
+        self.los_table = None
+        # walk tables by (start cell, max moves, grouped), least recently used first
+        self.walk_tables = collections.OrderedDict()
+        self.walk_table_turns = 0 # number of turns in walk_tables
+        # bitboard masks, where bit i is set for cell index i
+        self.cell_masks = None # masks of cells by type, depend on smoke
+        self.range_masks = {}  # masks of cells within a distance of a cell, never change
+        self.geometry = None # BoardGeometry of the file, None for an empty board
+        if not init_empty:
+            self.geometry = BoardGeometry.load(path)
+            # only the cells can change (with smoke), the rest is the geometry's until they do
+            self.board_cells = [list(row) for row in self.geometry.rows]
+            self.backup = self.geometry.rows
+            self.neighbors = self.geometry.neighbors
+            self.road_table = self.geometry.road_table
+            self.los_table = self.geometry.los_table
+            self.cell_masks = self.geometry.cell_masks
+        else:
+            self.board_cells = [[0 for c in range(N_COLS)] for r in range(N_ROWS)]
+            self.backup = [[0 for c in range(N_COLS)] for r in range(N_ROWS)]
+
+    def get(self, bp):
+        return self.board_cells[bp.row][bp.col]
+
+    def set(self, bp, val):
+        self.board_cells[bp.row][bp.col] = val
+
+    def place_smoke(self, bp):
+        # should only occur if testing
+        if self.smokep is not None:
+            self.clear_smoke()
+        self.smokep = bp
+        adj = self.adjacent(self.smokep, only_passable=True)
+        for p in adj:
+            self.set(p, SMOKE_GRENADE)
+        # smoke blocks LOS. it doesn't block movement, so the walk tables are still good
+        self.los_table = None
+        self.cell_masks = None
+
+    def clear_smoke(self):
+        adj = self.adjacent(self.smokep, only_passable=True)
+        for p in adj:
+            self.set(p, self.backup[p.row][p.col])
+        self.smokep = None
+        # back to the board without smoke
+        self.los_table = self.geometry.los_table if self.geometry is not None else None
+        self.cell_masks = self.geometry.cell_masks if self.geometry is not None else None
+
+    def contains(self, bp):
+        return bp.col >=0 and bp.col < N_COLS and bp.row >= 0 and bp.row < N_ROWS
+
+    def is_road(self, bp):
+        # check backup board because main might have been overwritten with SMOKE
+        return self.backup[bp.row][bp.col] == ROAD
+
+    def is_passable(self, bp):
+        cell = self.get(bp)
+        return cell == ROAD or cell == PATH or cell == SMOKE_GRENADE
+
+    def is_wall(self, bp):
+        cell = self.get(bp)
+        return cell == WALL
+
+    def is_transparent(self, bp):
+        cell = self.get(bp)
+        return cell == ROAD or cell == PATH
+
+    def is_objective(self, bp):
+        cell = self.get(bp)
+        return cell >= 'a' and cell <= 'z'
+
+    # returns list of positions adjacent to bp, with the optional condition they must be passable
+    def adjacent(self, bp, dist=1, only_passable=False):
+        n=[]
+        for r in range(bp.row-dist, bp.row+dist+1):
+            for c in range(bp.col-dist, bp.col+dist+1):
+                if r >= 0 and r < N_ROWS and c >= 0 and c < N_COLS and (r != bp.row or c != bp.col):
+                    nbp = BoardPosition(r,c)
+                    if not only_passable or self.is_passable(nbp):
+                        n.append(nbp)
+        return n
+
+    # returns a table, indexed by cell index, of the cell indices of passable neighbors
+    # smoke doesn't change what is passable, so the table only needs to be built once
+    def passable_neighbors(self):
+        if self.neighbors is None:
+            self.neighbors = [tuple(p.index() for p in self.adjacent(BoardPosition.from_index(i), only_passable=True))
+                              for i in range(N_ROWS*N_COLS)]
+        return self.neighbors
+
+    # returns every sequence of up to max_moves moves starting at cell index start, in order of
+    #  increasing length
+    def move_sequences(self, start, max_moves):
+        nbrs = self.passable_neighbors()
+        # we'll have a list for each possible move sequence length
+        # length 0 consists of staying put
+        n_moves_list = [[(start,)]]
+        for l in range(1, max_moves+1):
+            # initialize the list for this sequence length
+            n_moves_list.append([])
+            # we take every sequence from the previous length and expand by one move
+            for moves in n_moves_list[l-1]:
+                # grab where the sequence stopped
+                last_pos = moves[-1]
+                # look up the neighbors of that position
+                for j in nbrs[last_pos]:
+                    new_moves=moves+(j,)
+                    n_moves_list[l].append(new_moves)
+        return [t for moves in n_moves_list for t in moves]
+
+    # returns every move sequence of up to max_moves moves starting at cell index start,
+    #  grouped into ReachTurn classes of sequences with the same end position, visited cells
+    #  and length
+    def reach_classes(self, start, max_moves):
+        nbrs = self.passable_neighbors()
+        # frontier maps (end, visited mask) to the number of sequences of the current length
+        frontier = {(start, 1 << start): 1}
+        classes = [ReachTurn(start, start, 1 << start, 0, 1, nbrs)]
+        for l in range(1, max_moves+1):
+            next_frontier = {}
+            for (end, mask), cnt in frontier.items():
+                for n in nbrs[end]:
+                    k = (n, mask | (1 << n))
+                    next_frontier[k] = next_frontier.get(k, 0) + cnt
+            for (end, mask), cnt in next_frontier.items():
+                classes.append(ReachTurn(start, end, mask, l, cnt, nbrs))
+            frontier = next_frontier
+        return classes
+
+    # returns (turns, columns) for the walks of up to max_moves moves from cell index start,
+    #  where turns is reach_classes() if grouped or else move_sequences(), and columns is their
+    #  ParticleStore.turn_columns() if requested (or None)
+    # the tables only depend on what is passable, so they are built the first time they're
+    #  needed and then kept, up to WALK_CACHE_TURNS turns, dropping the least recently used.
+    #  they are shared by every agent that propagates from start, so must not be modified
+    def walk_table(self, start, max_moves, grouped=False, columns=False):
+        k = (start, max_moves, grouped)
+        table = self.walk_tables.get(k)
+        if table is None:
+            turns = self.reach_classes(start, max_moves) if grouped else self.move_sequences(start, max_moves)
+            table = (turns, None)
+            self.__cache_walk_table(k, table)
+        else:
+            self.walk_tables.move_to_end(k)
+        if columns and table[1] is None:
+            table = (table[0], ParticleStore.turn_columns(table[0]))
+            self.walk_tables[k] = table
+        return table[0], table[1] if columns else None
+
+    # adds a walk table built elsewhere (by a propagation worker) to the cache
+    def add_walk_table(self, start, max_moves, grouped, table):
+        k = (start, max_moves, grouped)
+        if k not in self.walk_tables:
+            self.__cache_walk_table(k, table)
+
+    def __cache_walk_table(self, k, table):
+        self.walk_tables[k] = table
+        self.walk_table_turns += len(table[0])
+        while self.walk_table_turns > self.WALK_CACHE_TURNS and len(self.walk_tables) > 1:
+            old_k, old_table = self.walk_tables.popitem(last=False)
+            self.walk_table_turns -= len(old_table[0])
+
+    # returns the road cells seen looking along the road from cell index i in direction d
+    #  (0-3, E/N/W/S as for BoardPosition): those of the lane i is on and those of the lane
+    #  paired with it (see RoadSegment), each ordered outward from i. both are empty unless i
+    #  is on a road segment along d. smoke doesn't change the roads
+    def road_lanes(self, i, d):
+        if self.road_table is None:
+            self.road_table = RoadSegment.lane_table(RoadSegment.extract(self.backup))
+        return self.road_table[i*4 + d]
+
+    # road_lanes in each direction from bp, as positions, e.g. rl['E'] = [same lane, paired lane]
+    def roads_connected_to(self, bp):
+        i = bp.index()
+        rl={}
+        for d, k in enumerate(BoardPosition.D_LOOKUP):
+            rl[k] = [[BoardPosition.from_index(c) for c in lane] for lane in self.road_lanes(i, d)]
+        return rl
+
+    def hunter_los(self, hp):
+        los = [hp]
+        if self.is_transparent(hp):
+            i = hp.index()
+
+            # hunter is looking E
+            if hp.d == 0 or hp.d == -1:
+                # accumulate LOS along this row
+                for c in range(hp.col+1, N_COLS):
+                    bp = BoardPosition(hp.row, c)
+                    if self.is_transparent(bp):
+                        los.append(bp)
+                    else:
+                        break
+                if self.is_road(hp):
+                    for lane in self.road_lanes(i, 0):
+                        for p in map(BoardPosition.from_index, lane):
+                            if self.is_transparent(p):
+                                los.append(p)
+                            else:
+                                # road positions are ordered outward from hp, so stop
+                                # processing when visibility ends
+                                break
+
+            # hunter is looking N
+            if hp.d == 1 or hp.d == -1:
+                # accumulate LOS along this col
+                for r in range(hp.row-1, -1, -1):
+                    bp = BoardPosition(r, hp.col)
+                    if self.is_transparent(bp):
+                        los.append(bp)
+                    else:
+                        break
+                if self.is_road(hp):
+                    for lane in self.road_lanes(i, 1):
+                        for p in map(BoardPosition.from_index, lane):
+                            if self.is_transparent(p):
+                                los.append(p)
+                            else:
+                                # road positions are ordered outward from hp, so stop
+                                # processing when visibility ends
+                                break
+
+            # hunter is looking W
+            if hp.d == 2 or hp.d == -1:
+                # accumulate LOS along this row
+                for c in range(hp.col-1, -1, -1):
+                    bp = BoardPosition(hp.row, c)
+                    if self.is_transparent(bp):
+                        los.append(bp)
+                    else:
+                        break
+                if self.is_road(hp):
+                    for lane in self.road_lanes(i, 2):
+                        for p in map(BoardPosition.from_index, lane):
+                            if self.is_transparent(p):
+                                los.append(p)
+                            else:
+                                # road positions are ordered outward from hp, so stop
+                                # processing when visibility ends
+                                break
+
+            # hunter is looking S
+            if hp.d == 3 or hp.d == -1:
+                # accumulate LOS along this col
+                for r in range(hp.row+1, N_ROWS):
+                    bp = BoardPosition(r, hp.col)
+                    if self.is_transparent(bp):
+                        los.append(bp)
+                    else:
+                        break
+                if self.is_road(hp):
+                    for lane in self.road_lanes(i, 3):
+                        for p in map(BoardPosition.from_index, lane):
+                            if self.is_transparent(p):
+                                los.append(p)
+                            else:
+                                # road positions are ordered outward from hp, so stop
+                                # processing when visibility ends
+                                break
+        return los
+
+    # returns a bitmask of the cells in the LOS of a hunter at hp (including hp itself)
+    # the LOS of every cell and facing (E/N/W/S/any) is computed once and reused until smoke
+    #  changes what is transparent
+    def hunter_los_mask(self, hp):
+        if self.los_table is None:
+            self.los_table = []
+            for i in range(N_ROWS*N_COLS):
+                for d in range(-1, 4):
+                    p = BoardPosition.from_index(i)
+                    p.d = d
+                    self.los_table.append(self.positions_mask(self.hunter_los(p)))
+        return self.los_table[hp.index()*5 + hp.d + 1]
+
+    # returns a bitmask of all cells of a given type: 'passable', 'transparent', 'road' or 'objective'
+    def cell_mask(self, kind):
+        if self.cell_masks is None:
+            self.cell_masks = {'passable':0, 'transparent':0, 'road':0, 'objective':0}
+            for i in range(N_ROWS*N_COLS):
+                bp = BoardPosition.from_index(i)
+                if self.is_passable(bp):
+                    self.cell_masks['passable'] |= 1 << i
+                if self.is_transparent(bp):
+                    self.cell_masks['transparent'] |= 1 << i
+                if self.is_road(bp):
+                    self.cell_masks['road'] |= 1 << i
+                if self.is_objective(bp):
+                    self.cell_masks['objective'] |= 1 << i
+        return self.cell_masks[kind]
+
+    # returns a bitmask of the cells no more than dist away from bp (including bp itself)
+    def range_mask(self, bp, dist):
+        k = (bp.row, bp.col, dist)
+        m = self.range_masks.get(k)
+        if m is None:
+            m = 0
+            for r in range(max(bp.row-dist, 0), min(bp.row+dist+1, N_ROWS)):
+                for c in range(max(bp.col-dist, 0), min(bp.col+dist+1, N_COLS)):
+                    m |= 1 << (r*N_COLS + c)
+            self.range_masks[k] = m
+        return m
+
+    # bitmask version of adjacent()
+    def adjacent_mask(self, bp, dist=1, only_passable=False):
+        m = self.range_mask(bp, dist)
+        if self.contains(bp):
+            m &= ~(1 << bp.index())
+        if only_passable:
+            m &= self.cell_mask('passable')
+        return m
+
+    # returns a bitmask of the cells with an objective no more than dist away
+    def objective_near_mask(self, dist):
+        k = ('objective', dist)
+        m = self.range_masks.get(k)
+        if m is None:
+            m = 0
+            for p in self.mask_positions(self.cell_mask('objective')):
+                m |= self.adjacent_mask(p, dist)
+            self.range_masks[k] = m
+        return m
+
+    # returns a bitmask of the cells in direction d (e.g. NW, E, etc) of cp, as reported
+    #  by the motion sensor
+    def motion_mask(self, cp, d):
+        k = (cp.row, cp.col, d)
+        m = self.range_masks.get(k)
+        if m is None:
+            m = 0
+            if d in MOTION_DIRECTIONS:
+                dr, dc = MOTION_DIRECTIONS[d]
+                for i in range(N_ROWS*N_COLS):
+                    r, c = divmod(i, N_COLS)
+                    if (r > cp.row) - (r < cp.row) == dr and (c > cp.col) - (c < cp.col) == dc:
+                        m |= 1 << i
+            self.range_masks[k] = m
+        return m
+
+    @staticmethod
+    def positions_mask(positions):
+        m = 0
+        for p in positions:
+            m |= 1 << p.index()
+        return m
+
+    @staticmethod
+    def cells_mask(cells):
+        m = 0
+        for i in cells:
+            m |= 1 << i
+        return m
+
+    @staticmethod
+    def mask_cells(m):
+        cells=[]
+        while m:
+            low = m & -m
+            cells.append(low.bit_length() - 1)
+            m ^= low
+        return cells
+
+    @staticmethod
+    def mask_positions(m):
+        return [BoardPosition.from_index(i) for i in Board.mask_cells(m)]
+
+    def print(self):
+        for r in range(0,N_ROWS):
+            for c in range(0,N_COLS):
+                print(self.board_cells[r][c],end='')
+            print()
+
+
+# a class of move sequences for a single turn that share the same start, end, set of visited
+#  cells and length, standing in for the tuple of cell indices used by the path engine
+#
+# observations that only care about where the agent started/ended, which cells they touched
+#  and how far they moved can use it like the tuple (len(), [0], [-1], iteration over the
+#  visited cells, which are NOT in move order), while observations that depend on the order
+#  of the moves can expand it into the individual sequences with paths()
+class ReachTurn():
+    __slots__ = ('start', 'end', 'mask', 'length', 'count', 'nbrs', 'walks')
+
+    def __init__(self, start, end, mask, length, count, nbrs, walks=None):
+        self.start = start   # cell index
+        self.end = end       # cell index
+        self.mask = mask     # bitmask of visited cell indices
+        self.length = length # number of moves
+        self.count = count   # number of move sequences in this class
+        self.nbrs = nbrs     # passable neighbor table, used to enumerate the sequences
+        self.walks = walks   # explicit list of sequences, if the class has been restricted
+
+    def __len__(self):
+        return self.length + 1
+
+    def __getitem__(self, idx):
+        if idx == 0:
+            return self.start
+        elif idx == -1 or idx == self.length:
+            return self.end
+        raise IndexError('only the start and end of a reachability turn can be indexed')
+
+    def __iter__(self):
+        return iter(Board.mask_cells(self.mask))
+
+    def __str__(self):
+        return '%s-{%s}->%s x%d' % (BoardPosition.from_index(self.start),
+                                   ' '.join(str(BoardPosition.from_index(i)) for i in self),
+                                   BoardPosition.from_index(self.end), self.count)
+
+    # returns the explicit move sequences (as tuples of cell indices) in this class
+    def paths(self):
+        if self.walks is not None:
+            return self.walks
+        walks=[]
+        seq=[self.start]
+        end=BoardPosition.from_index(self.end)
+        def extend(visited):
+            remaining = self.length + 1 - len(seq)
+            if remaining == 0:
+                if seq[-1] == self.end and visited == self.mask:
+                    walks.append(tuple(seq))
+                return
+            for n in self.nbrs[seq[-1]]:
+                # stay inside the visited cells, and close enough to still reach the end
+                if (self.mask >> n) & 1 and BoardPosition.from_index(n).dist(end) < remaining:
+                    seq.append(n)
+                    extend(visited | (1 << n))
+                    seq.pop()
+        extend(1 << self.start)
+        return walks
+
+    # returns a copy of this class containing only the given sequences
+    def restricted(self, walks):
+        return ReachTurn(self.start, self.end, self.mask, self.length, len(walks), self.nbrs, walks)
+
+
+# one turn of an agent's history, linked to the turn before it
+#
+# agents propagated from the same agent share the nodes for the turns they have in common,
+#  so the history takes one node per unique turn rather than a copy per agent. nodes are
+#  only referenced by their children and the agents ending in them, so when agents are
+#  filtered out, the nodes nothing else leads to are freed by reference counting
+class TurnNode():
+    __slots__ = ('parent', 'turn', 'depth')
+
+    def __init__(self, parent, turn):
+        self.parent = parent # TurnNode for the previous turn, None for the start of the game
+        self.turn = turn     # sequence of cell indices (or ReachTurn) for this turn
+        self.depth = 0 if parent is None else parent.depth + 1
+
+
+# TODO: need a way to flip HIDDEN to SURGE or STEALTH
+#
+# positions are stored as cell indices (see BoardPosition.index()), the equipment is a tuple
+#  and the history is a TurnNode, none of which are modified in place, so clones share them
+#  with the agent they were cloned from
+#
+# measured with tracemalloc at the third turn of a game, a particle takes ~130 bytes, down
+#  from ~1750 (path engine) and ~1000 (reach engine) with lists of BoardPosition objects
+class Agent():
+    __slots__ = ('weight', 'equip_list', 'node')
+
+    EQUIP_UNKNOWN=-1
+    EQUIP_HIDDEN=0
+    EQUIP_SURGE=1
+    EQUIP_STEALTH=2
+    EQUIP_FLASH=3
+    EQUIP_SMOKE=4
+    EQUIP_UNIQUE=5
+
+    START_CELL=BoardPosition.from_string('N1').index()
+    START_NODE=TurnNode(None, (START_CELL,))
+
+    def  __init__(self,equip_slots=5):
+        self.weight = 1 # number of possible paths this agent represent
+        self.equip_list = (self.EQUIP_UNKNOWN,) * equip_slots # INVARIANT: list[i] >= list[j] for i <= j
+        self.node=self.START_NODE # the agent's last turn, see turn_history
+
+    def __str__(self):
+        retv='id: '
+
+        retv += '\nequipment:'
+        for e in self.equip_list:
+            retv += ' unknown' if e == Agent.EQUIP_UNKNOWN else (
+                    ' unique'  if e == Agent.EQUIP_UNIQUE else (
+                    ' surge'   if e == Agent.EQUIP_SURGE else (
+                    ' stealth' if e == Agent.EQUIP_STEALTH else (
+                    ' flash'   if e == Agent.EQUIP_FLASH else (
+                    ' smoke'   if e == Agent.EQUIP_SMOKE else 'hidden' )))))
+        retv += '\npos:'
+        for p in self.position_history:
+            retv += ' %s' % BoardPosition.from_index(p)
+        retv += '\nturns:'
+        for t in self.turn_history:
+            if isinstance(t, ReachTurn):
+                retv += ' %s' % t
+            else:
+                for p in t:
+                    retv += ' %s' % BoardPosition.from_index(p)
+            retv += ' |'
+        retv += '\n'
+        return retv
+
+    def clone(self,other):
+        self.weight = other.weight
+        self.equip_list = other.equip_list
+        self.node = other.node
+
+    def add_turn(self,turn):
+        self.node = TurnNode(self.node, turn)
+
+    # history[i] is the sequence of positions for turn i, reconstructed from the TurnNodes
+    # INVARIANT:
+    #   turn_history[i][0] == position_history[i-1]
+    #   turn_history[i][-1] == position_history[i]
+    @property
+    def turn_history(self):
+        turns=[]
+        n = self.node
+        while n is not None:
+            turns.append(n.turn)
+            n = n.parent
+        return tuple(reversed(turns))
+
+    # history[i] is where the agent ended turn i
+    @property
+    def position_history(self):
+        return tuple(t[-1] for t in self.turn_history)
+
+    # number of turns the agent has been propagated
+    def num_turns(self):
+        return self.node.depth
+
+    # returns the TurnNode for turn idx, with negative indexes counting back from the last turn
+    def __get_node(self,idx):
+        steps = -idx-1 if idx < 0 else self.node.depth - idx
+        if steps < 0 or steps > self.node.depth:
+            raise IndexError('turn index out of range')
+        n = self.node
+        for i in range(steps):
+            n = n.parent
+        return n
+
+    def get_turn(self,idx=-1):
+        return self.__get_node(idx).turn
+
+    # returns the explicit move sequences the given turn could have been
+    def turn_paths(self,idx=-1):
+        t = self.get_turn(idx)
+        return t.paths() if isinstance(t, ReachTurn) else [t]
+
+    # returns a bitmask of the cells visited during the given turn
+    def turn_mask(self,idx=-1):
+        t = self.get_turn(idx)
+        return t.mask if isinstance(t, ReachTurn) else Board.cells_mask(t)
+
+    # keep only the given move sequences (from turn_paths()) for the last turn, scaling the
+    #  weight by the fraction of sequences kept
+    def restrict_turn(self,paths):
+        t = self.node.turn
+        if isinstance(t, ReachTurn) and len(paths) != t.count:
+            # weights are whole numbers of paths, unless they've been resampled
+            if isinstance(self.weight, int):
+                self.weight = self.weight * len(paths) // t.count
+            else:
+                self.weight = self.weight * len(paths) / t.count
+            self.node = TurnNode(self.node.parent, t.restricted(paths))
+
+    # returns the cell index where the agent ended the given turn
+    def get_position(self,idx=-1):
+        return self.__get_node(idx).turn[-1]
+
+    def num_equip(self,e=EQUIP_UNKNOWN):
+        index = [i for i in range(len(self.equip_list)) if self.equip_list[i] == e]
+        if e==Agent.EQUIP_HIDDEN:
+            index2 = [i for i in range(len(self.equip_list)) if self.equip_list[i] == Agent.EQUIP_SURGE]
+            index.append(index2)
+            index2 = [i for i in range(len(self.equip_list)) if self.equip_list[i] == Agent.EQUIP_STEALTH]
+            index.append(index2)
+        return len(index)
+
+    def set_equip(self,e):
+        # determine where the equipment should go, i.e. the first UNKNOWN spot
+        index = len(self.equip_list) - self.num_equip(Agent.EQUIP_UNKNOWN)
+        equip_list = list(self.equip_list)
+        # if there's space, and if we're not maxed on this equippment
+        if index < len(equip_list) and self.num_equip_possible(e) > 0:
+            equip_list[index] = e
+        # keep the list in proper order
+        self.equip_list = tuple(sorted(equip_list))
+
+    def has_unknown_equip(self):
+        return self.num_equip(Agent.EQUIP_UNKNOWN) > 0
+
+    # return the number of possible unknown equipment cards of a given type an agent might have
+    # for example, an agent known to have played "stealth field" with three remaining unknown
+    #  equipments can only possibly have one more stealth field
+    # or, an agent cannot have any more smoke grenades if all equipment has been identified
+    def num_equip_possible(self,e):
+        if e == Agent.EQUIP_UNKNOWN:
+            return 0 # this isn't a real equipment type
+        else:
+            # determine known equipment of the given type
+            cnt = self.num_equip(e)
+            max_num = 2
+            if e == Agent.EQUIP_UNIQUE:
+                # there can only be one unique equipment card
+                max_num = 1
+            elif e == Agent.EQUIP_HIDDEN:
+                max_num = 4
+            # number of slots is smaller of total open and open of this equip type
+            return min(max_num - cnt, self.num_equip(Agent.EQUIP_UNKNOWN))
+
+    # hashable particle key used to collapse agents with a dict: the equipment list and the
+    #  last two end positions
+    # need to consider two turns to allow post-cog to work
+    def key(self):
+        n = self.node
+        if n.parent is None:
+            return (self.equip_list, n.turn[-1])
+        return (self.equip_list, n.parent.turn[-1], n.turn[-1])
+
+
+# column-oriented copy of the per-agent data the observation filters look at, so that with
+#  numpy available each observation is a boolean mask computed in one vectorized pass
+#
+# the Agent objects remain the source of truth (and are kept alongside in an object array),
+#  so the store only needs to be rebuilt when the agent list changes outside of a filter
+class ParticleStore():
+    N_MASK_WORDS = (N_ROWS*N_COLS + 63) // 64
+    N_EQUIP_TYPES = Agent.EQUIP_UNIQUE - Agent.EQUIP_UNKNOWN + 1
+
+    def __init__(self, agents, end, start, prev, length, equip, weight, visited):
+        self.agents = agents   # Agent objects
+        self.end = end         # cell index where the last turn ended
+        self.start = start     # cell index where the last turn started
+        self.prev = prev       # cell index where the agent was two turns ago, -1 if unknown
+        self.length = length   # number of positions in the last turn
+        self.equip = equip     # number of equipment slots of each type, column e-EQUIP_UNKNOWN
+        self.weight = weight
+        self.visited = visited # bitmask of cells visited during the last turn, as 64-bit words
+
+    @classmethod
+    def from_agents(cls, agent_list):
+        n = len(agent_list)
+        agents = np.empty(n, dtype=object)
+        agents[:] = agent_list
+        # gather into lists first, setting numpy elements one at a time is much slower
+        end=[]
+        start=[]
+        prev=[]
+        length=[]
+        equip=[]
+        weight=[]
+        visited=bytearray()
+        nbytes = cls.N_MASK_WORDS*8
+        for a in agent_list:
+            node = a.node
+            end.append(node.turn[-1])
+            start.append(node.turn[0])
+            prev.append(node.parent.parent.turn[-1] if node.depth >= 2 else -1)
+            length.append(len(a.get_turn()))
+            equip.extend(a.equip_list)
+            weight.append(a.weight)
+            visited += a.turn_mask().to_bytes(nbytes, 'little')
+        equip = np.array(equip, dtype=np.int8).reshape(n, len(agent_list[0].equip_list) if n > 0 else 0)
+        equip = np.stack([(equip == e).sum(axis=1, dtype=np.int8)
+                          for e in range(Agent.EQUIP_UNKNOWN, Agent.EQUIP_UNIQUE+1)], axis=1)
+        return cls(agents, np.array(end, dtype=np.int16), np.array(start, dtype=np.int16),
+                   np.array(prev, dtype=np.int16), np.array(length, dtype=np.int8), equip,
+                   np.array(weight, dtype=np.float64),
+                   np.frombuffer(bytes(visited), dtype='<u8').reshape(n, cls.N_MASK_WORDS))
+
+    # returns the columns (end, length, visited, number of sequences) describing a list of
+    #  turns, either lists of positions or ReachTurns
+    @classmethod
+    def turn_columns(cls, turns):
+        n = len(turns)
+        end = np.array([t[-1] for t in turns], dtype=np.int16)
+        length = np.array([len(t) for t in turns], dtype=np.int8)
+        count = np.array([t.count if isinstance(t, ReachTurn) else 1 for t in turns], dtype=np.float64)
+        visited = bytearray()
+        for t in turns:
+            m = t.mask if isinstance(t, ReachTurn) else Board.cells_mask(t)
+            visited += m.to_bytes(cls.N_MASK_WORDS*8, 'little')
+        visited = np.frombuffer(bytes(visited), dtype='<u8').reshape(n, cls.N_MASK_WORDS)
+        # the columns are cached with the walk tables, so they're shared
+        for c in (end, length, count):
+            c.setflags(write=False)
+        return end, length, visited, count
+
+    # returns the (agent-less) store rows for the children parent gets from propagating with
+    #  the given turn_columns
+    @classmethod
+    def children(cls, parent, columns):
+        node = parent.node
+        equip = np.zeros(cls.N_EQUIP_TYPES, dtype=np.int8)
+        for e in parent.equip_list:
+            equip[e - Agent.EQUIP_UNKNOWN] += 1
+        return cls.expand(equip, node.turn[-1], node.parent.turn[-1] if node.depth >= 1 else -1,
+                          parent.weight, columns)
+
+    # returns the (agent-less) store rows for taking each turn in turn_columns from start, with
+    #  the given equipment counts, position two turns ago and weight beforehand
+    @classmethod
+    def expand(cls, equip, start, prev, weight, columns):
+        end, length, visited, count = columns
+        k = len(end)
+        equip = np.tile(equip, (k, 1))
+        rows = cls(None, end, np.full(k, start, dtype=np.int16), np.full(k, prev, dtype=np.int16),
+                   length, equip, weight * count, visited)
+        # propagation notes "adrenal surge" for turns longer than a normal move
+        surge = length > NUM_MOVES_PER_TURN+1
+        if surge.any():
+            rows.set_equip(surge & (rows.num_equip_possible(Agent.EQUIP_SURGE) > 0), Agent.EQUIP_SURGE)
+        return rows
+
+    # joins store rows from children() into a single store for the given agents (or into
+    #  more agent-less rows if agent_list is None)
+    @classmethod
+    def concatenate(cls, blocks, agent_list):
+        if agent_list is None:
+            agents = None
+        elif len(blocks) == 0:
+            return cls.from_agents(agent_list)
+        else:
+            agents = np.empty(len(agent_list), dtype=object)
+            agents[:] = agent_list
+        return cls(agents, *[np.concatenate([getattr(b, c) for b in blocks])
+                             for c in ('end', 'start', 'prev', 'length', 'equip', 'weight', 'visited')])
+
+    def __len__(self):
+        return len(self.end)
+
+    # returns a new store with only the rows where keep is true
+    def select(self, keep):
+        return ParticleStore(self.agents[keep] if self.agents is not None else None, self.end[keep], self.start[keep], self.prev[keep],
+                             self.length[keep], self.equip[keep], self.weight[keep], self.visited[keep])
+
+    # convert a board bitmask into a boolean array indexed by cell index
+    @staticmethod
+    def cells(m):
+        b = np.frombuffer(m.to_bytes(ParticleStore.N_MASK_WORDS*8, 'little'), dtype=np.uint8)
+        return np.unpackbits(b, bitorder='little')[:N_ROWS*N_COLS].astype(bool)
+
+    # true for rows that visited any cell in the board bitmask m during the last turn
+    def touches(self, m):
+        w = np.frombuffer(m.to_bytes(self.N_MASK_WORDS*8, 'little'), dtype='<u8')
+        return (self.visited & w).any(axis=1)
+
+    # vectorized Agent.num_equip_possible
+    def num_equip_possible(self, e):
+        if e == Agent.EQUIP_UNKNOWN:
+            return np.zeros(len(self), dtype=np.int8)
+        cnt = self.equip[:, e - Agent.EQUIP_UNKNOWN]
+        max_num = 2
+        if e == Agent.EQUIP_UNIQUE:
+            max_num = 1
+        elif e == Agent.EQUIP_HIDDEN:
+            max_num = 4
+            # matches Agent.num_equip, which counts two extra for hidden equipment
+            cnt = cnt + 2
+        return np.minimum(max_num - cnt, self.equip[:, 0])
+
+    # set_equip for the rows where rows is true, which must all have the equipment possible
+    #
+    # the equipment column and the agents are replaced rather than changed in place (the
+    #  agents that get the equipment are copies), so other stores sharing them are unchanged
+    def set_equip(self, rows, e):
+        rows = np.flatnonzero(rows)
+        if self.agents is not None:
+            agents = self.agents.copy()
+            for i in rows:
+                a = Agent()
+                a.clone(agents[i])
+                a.set_equip(e)
+                agents[i] = a
+            self.agents = agents
+        # Agent.set_equip writes to the slot after the known ones in the sorted list, which
+        #  is an unknown slot only while fewer slots are known than unknown. otherwise it
+        #  replaces a known piece of equipment, the one at that position in type order
+        equip = self.equip[rows]
+        index = equip.sum(axis=1) - equip[:, 0]
+        col = (np.cumsum(equip, axis=1) <= index[:, None]).sum(axis=1)
+        self.equip = self.equip.copy()
+        self.equip[rows, col] -= 1
+        self.equip[rows, e - Agent.EQUIP_UNKNOWN] += 1
+
+    # bytes taken by the columns, leaving out any shared with other
+    def nbytes(self, other=None):
+        n = 0
+        for name in ('agents', 'end', 'start', 'prev', 'length', 'equip', 'weight', 'visited'):
+            c = getattr(self, name)
+            if c is not None and (other is None or c is not getattr(other, name)):
+                n += c.nbytes
+        return n
+
+
+def print_moves(new_moves):
+    for idx,p in enumerate(new_moves):
+        print(p,end='')
+        if idx==len(new_moves)-2:
+            print('->',end='')
+        elif idx==len(new_moves)-1:
+            print('')
+        else:
+            print('-',end='')
+
+def print_moves_list(moves_list):
+    for l in range(0, len(moves_list)):
+        print('length %d:' % l)
+        for m in moves_list[l]:
+            print_moves(m)
+
+
+# the simulation a propagation pool works on. the pool is forked from the process running the
+#  simulation, so the workers see its agents and board without them being sent over
+_worker_sim = None
+
+def _collapse_shard(bounds):
+    return _worker_sim.collapse_shard(*bounds)
+
+def _expand_shard(parents):
+    return _worker_sim.expand_shard(parents)
+
+# the WhatIf a what-if pool works on, forked the same way
+_worker_what_if = None
+
+def _what_if_shard(candidates):
+    return [_worker_what_if.evaluate(hp) for hp in candidates]
+
+
+# the log written with out_file, one JSON record per line (see read_log), counting its lines
+#  so a snapshot can note how much of the log it covers
+#
+# records are flushed to the file every flush_every records and, with fsync_every, synced to
+#  the disk every that many, so a crash loses at most that many. close() syncs what's left
+#
+# with append, the log keeps what it already has, and the first commands written are taken
+#  to be those lines being read back in: they're skipped rather than written again. once
+#  they've been read, unread() counts any the sim didn't get to and drop_unread() cuts them
+class LogFile():
+    def __init__(self, path, flush_every=1, fsync_every=None, append=False):
+        self.path = path
+        self.lines = 0
+        self.ends=[] # where each line already in the log ends, while they're being read back
+        if append:
+            with open(path, 'rb') as fd:
+                for l in fd:
+                    self.ends.append((self.ends[-1] if len(self.ends) > 0 else 0) + len(l))
+            self.fd = open(path, 'r+t')
+            # a last line cut short gets its end, so what's written next is a line of its own
+            if len(self.ends) > 0 and not l.endswith(b'\n'):
+                self.fd.seek(0, os.SEEK_END)
+                self.fd.write('\n')
+                self.ends[-1] += 1
+        else:
+            self.fd = open(path, 'wt')
+        self.flush_every = flush_every
+        self.fsync_every = fsync_every
+        self.unflushed = 0 # records written since the last flush
+        self.unsynced = 0  # and since the last fsync
+
+    # writes lines as they are, e.g. copied from another log
+    def write(self, text):
+        if self.lines < len(self.ends):
+            self.skip(text.count('\n'))
+            return
+        self.fd.write(text)
+        self.lines += text.count('\n')
+
+    # writes a command as a record, numbered by its line in the log and timed by the
+    #  monotonic clock, so the times only compare within a session
+    def record(self, cmd, *args):
+        if self.lines < len(self.ends):
+            self.skip(1)
+            return
+        self.write(json.dumps({'seq': self.lines+1, 't': round(time.monotonic(), 6), 'cmd': cmd, 'args': args},
+                              separators=(',', ':')) + '\n')
+        self.unflushed += 1
+        self.unsynced += 1
+        if self.fsync_every is not None and self.unsynced >= self.fsync_every:
+            self.sync()
+        elif self.unflushed >= self.flush_every:
+            self.flush()
+
+    # moves past n lines already in the log
+    def skip(self, n):
+        self.lines += n
+        self.fd.seek(self.ends[self.lines-1] if self.lines > 0 else 0)
+
+    # the number of lines already in the log that weren't read back
+    def unread(self):
+        return len(self.ends) - self.lines
+
+    # cuts the lines already in the log that weren't read back, returning how many there were
+    def drop_unread(self):
+        n = self.unread()
+        if n > 0:
+            self.skip(0)
+            self.fd.truncate()
+        self.ends=[]
+        return n
+
+    def flush(self):
+        self.fd.flush()
+        self.unflushed = 0
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.fd.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.fd.closed:
+            self.sync()
+            self.fd.close()
+
+    # where the log is up to, for truncate
+    def mark(self):
+        self.flush()
+        return (self.fd.tell(), self.lines)
+
+    # drops the lines written since mark, returning them
+    def truncate(self, mark):
+        self.flush()
+        with open(self.path, 'rt') as fd:
+            fd.seek(mark[0])
+            text = fd.read()
+        self.fd.seek(mark[0])
+        self.fd.truncate()
+        self.lines = mark[1]
+        return text
+
+
+# reads the commands of a log from fd, yielding the line number and the command as a list of
+#  its name and arguments, the tokens Sim.parse_command takes. stops at the first blank line
+#
+# records written by LogFile are checked: their seq has to be their line number (first_line
+#  is the number of the next line read from fd) and their fields the right types, otherwise
+#  ValueError is raised. lines that aren't records are commands in the older text format,
+#  split on whitespace
+def read_log(fd, first_line=1):
+    for line_num, l in enumerate(fd, first_line):
+        if l.startswith('{'):
+            try:
+                r = json.loads(l)
+            except ValueError:
+                raise ValueError('line %d: bad record' % line_num)
+            if not (isinstance(r, dict) and r.get('seq') == line_num and
+                    isinstance(r.get('t'), (int, float)) and isinstance(r.get('cmd'), str) and
+                    isinstance(r.get('args'), list) and all(isinstance(a, str) for a in r['args'])):
+                raise ValueError('line %d: bad record %s' % (line_num, l.strip()))
+            yield line_num, [r['cmd']] + r['args']
+        else:
+            t = l.split()
+            if len(t) == 0:
+                return
+            yield line_num, t
+
+
+# puts the smoke grenade back where it was in a saved state, if it has moved
+def restore_smoke(board, smokep):
+    if (board.smokep is None) != (smokep is None) or smokep is not None and board.smokep.index() != smokep.index():
+        if board.smokep is not None:
+            board.clear_smoke()
+        if smokep is not None:
+            board.place_smoke(smokep)
+
+
+# a binary snapshot: a header, then named sections of fixed size values (array module
+#  typecodes), little endian and each aligned to 8 bytes
+#
+# read() reads each section straight into an array of its size, so the columns are copied
+#  once rather than parsed, and the file is closed again before it returns (undo removes
+#  snapshots it has read)
+class Snapshot():
+    MAGIC=b'SPSN'
+    VERSION=1
+    HEADER=struct.Struct('<4sII4x')
+    SECTION=struct.Struct('<4sc3xQ')
+
+    def __init__(self):
+        self.sections={}
+
+    def add(self, tag, typecode, values):
+        self.sections[tag] = array.array(typecode, values)
+
+    def get(self, tag):
+        return self.sections[tag]
+
+    # written to a temporary file and moved over path, so a crash never leaves half a snapshot.
+    #  the temporary file is the process's own, as several can write the same board cache
+    def write(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fd:
+            fd.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(self.sections)))
+            for tag, a in self.sections.items():
+                if sys.byteorder != 'little':
+                    a = array.array(a.typecode, a)
+                    a.byteswap()
+                data = a.tobytes()
+                fd.write(self.SECTION.pack(tag.encode(), a.typecode.encode(), len(a)))
+                fd.write(data)
+                fd.write(b'\0' * (-len(data) % 8))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path):
+        snap = cls()
+        with open(path, 'rb') as fd:
+            file_size = os.fstat(fd.fileno()).st_size
+            header = fd.read(cls.HEADER.size)
+            if len(header) < cls.HEADER.size:
+                raise ValueError('%s is cut short' % path)
+            magic, version, n = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError('%s is not a version %d snapshot' % (path, cls.VERSION))
+            for i in range(n):
+                section = fd.read(cls.SECTION.size)
+                if len(section) < cls.SECTION.size:
+                    raise ValueError('%s is cut short' % path)
+                tag, typecode, count = cls.SECTION.unpack(section)
+                a = array.array(typecode.decode())
+                size = count * a.itemsize
+                if fd.tell() + size > file_size:
+                    raise ValueError('%s is cut short' % path)
+                # read straight into the array, the only copy made
+                a = array.array(a.typecode, [0]) * count
+                if fd.readinto(memoryview(a).cast('B')) < size:
+                    raise ValueError('%s is cut short' % path)
+                if sys.byteorder != 'little':
+                    a.byteswap()
+                snap.sections[tag.rstrip(b'\0').decode()] = a
+                fd.seek(-size % 8, os.SEEK_CUR)
+        return snap
+
+    # adds bitboard masks (see Board), ParticleStore.N_MASK_WORDS words each
+    def add_masks(self, tag, masks):
+        nbytes = ParticleStore.N_MASK_WORDS*8
+        self.add(tag, 'B', b''.join(m.to_bytes(nbytes, 'little') for m in masks))
+
+    def get_masks(self, tag):
+        data = self.get(tag)
+        nbytes = ParticleStore.N_MASK_WORDS*8
+        return [int.from_bytes(data[i:i+nbytes], 'little') for i in range(0, len(data), nbytes)]
+
+    # the state Sim and BeliefSim share: the propagation count, equipment and identity state,
+    #  smoke, missions and how many lines of the log the snapshot covers
+    def add_state(self, sim):
+        smoke = sim.board.smokep.index() if sim.board.smokep is not None else -1
+        self.add('ENGN', 'B', sim.engine.encode())
+        self.add('STAT', 'q', [sim.prop_count, sim.equip_used, sim.agent_id, smoke,
+                               sim.fdo.lines if sim.fdo is not None else 0])
+        self.add('MISN', 'h', [p.index() for p in sim.mission_pos])
+
+    # restores the state from add_state and returns the number of log lines covered
+    def load_state(self, sim):
+        engine = self.get('ENGN').tobytes().decode()
+        if (engine == Sim.ENGINE_BELIEF) != (sim.engine == Sim.ENGINE_BELIEF):
+            raise ValueError('snapshot is for the %s engine' % engine)
+        sim.prop_count, sim.equip_used, sim.agent_id, smoke, lines = self.get('STAT')
+        restore_smoke(sim.board, BoardPosition.from_index(smoke) if smoke >= 0 else None)
+        sim.mission_pos = [BoardPosition.from_index(i) for i in self.get('MISN')]
+        return lines
+
+    # adds ReachTurns (or move sequences) as sections tag+'K' (0 for a move sequence, 1 for a
+    #  class, 2 for a restricted class), tag+'R' (start, end, length of each class), tag+'N'
+    #  (their counts), tag+'M' (their masks) and tag+'C' (the cells of each move sequence and
+    #  of each restricted class's sequences), with tag+'O' the offset of each turn's cells
+    def add_turns(self, tag, turns):
+        kinds=[]
+        offsets=[0]
+        cells=[]
+        reach=[]
+        counts=[]
+        masks=[]
+        for t in turns:
+            if isinstance(t, ReachTurn):
+                kinds.append(1 if t.walks is None else 2)
+                reach.extend((t.start, t.end, t.length))
+                counts.append(t.count)
+                masks.extend(struct.unpack('<%dQ' % ParticleStore.N_MASK_WORDS,
+                                           t.mask.to_bytes(ParticleStore.N_MASK_WORDS*8, 'little')))
+                if t.walks is not None:
+                    for w in t.walks:
+                        cells.extend(w)
+            else:
+                kinds.append(0)
+                cells.extend(t)
+            offsets.append(len(cells))
+        self.add(tag + 'K', 'b', kinds)
+        self.add(tag + 'O', 'i', offsets)
+        self.add(tag + 'C', 'h', cells)
+        self.add(tag + 'R', 'h', reach)
+        self.add(tag + 'N', 'q', counts)
+        self.add(tag + 'M', 'Q', masks)
+
+    # returns the turns written by add_turns
+    def get_turns(self, tag, nbrs):
+        kinds = self.get(tag + 'K')
+        offsets = self.get(tag + 'O')
+        cells = self.get(tag + 'C')
+        reach = self.get(tag + 'R')
+        counts = self.get(tag + 'N')
+        masks = self.get(tag + 'M')
+        words = ParticleStore.N_MASK_WORDS
+        turns=[]
+        r = 0 # next class
+        for i, k in enumerate(kinds):
+            seq = tuple(cells[offsets[i]:offsets[i+1]])
+            if k == 0:
+                turns.append(seq)
+                continue
+            start, end, length = reach[3*r:3*r+3]
+            mask = int.from_bytes(masks[words*r:words*(r+1)].tobytes(), 'little')
+            t = ReachTurn(start, end, mask, length, counts[r], nbrs)
+            if k == 2:
+                t = t.restricted([seq[j:j+length+1] for j in range(0, len(seq), length+1)])
+            turns.append(t)
+            r += 1
+        return turns
+
+
+# collects the cost of each Sim command: the time it took, the number and total weight of the
+#  agents before and after, and how many memory blocks it left allocated
+#
+# every record is kept in records and, if there is one, passed to callback as a dict. with
+#  profile, each record also has the cProfile.Profile of the command. with trace_memory,
+#  tracemalloc is started and records have the bytes allocated and the peak during the command
+class Instrument():
+    def __init__(self, callback=None, profile=False, trace_memory=False):
+        self.callback = callback
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.records = []
+        self.depth = 0 # commands called by other commands are counted in the outer one
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def measure(self, sim, method, args, kwargs):
+        if self.depth > 0:
+            return method(sim, *args, **kwargs)
+        record = {'command': method.__name__, 'args': [str(a) for a in args]}
+        # counting the agents of a lazy propagation would make them, so they're left out
+        if not sim.streaming():
+            record['particles_in'] = sim.num_particles()
+            record['weight_in'] = sim.total_weight()
+        prof = cProfile.Profile() if self.profile else None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            mem_start = tracemalloc.get_traced_memory()[0]
+        blocks_start = sys.getallocatedblocks()
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            if prof is not None:
+                retv = prof.runcall(method, sim, *args, **kwargs)
+            else:
+                retv = method(sim, *args, **kwargs)
+        finally:
+            self.depth -= 1
+        record['seconds'] = time.perf_counter() - start
+        record['blocks'] = sys.getallocatedblocks() - blocks_start
+        if self.trace_memory:
+            mem, peak = tracemalloc.get_traced_memory()
+            record['bytes'] = mem - mem_start
+            record['peak_bytes'] = peak - mem_start
+        if prof is not None:
+            record['profile'] = prof
+        if not sim.streaming():
+            record['particles_out'] = sim.num_particles()
+            record['weight_out'] = sim.total_weight()
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return retv
+
+
+# raised by propagate when cancel() is called while it's running. the sim is left as it was
+#  before propagating
+class PropagationCancelled(Exception):
+    pass
+
+
+# what an observation keeps: keep(agent) is true for an agent consistent with it, and
+#  rows(store) is the same for each row of a ParticleStore
+#
+# with notes_equip, both also note "stealth field" on what they keep, which is why a filter
+#  is only ever applied once to each agent
+#
+# cost is how long a check takes relative to one on the agent's position (checks over the
+#  whole turn cost more)
+class ParticleFilter():
+    def __init__(self, keep, rows, notes_equip=False, cost=1):
+        self.keep = keep
+        self.rows = rows
+        self.notes_equip = notes_equip
+        self.cost = cost
+
+
+# marks a Sim method as a command, measured by the sim's instrument when it has one
+def instrumented(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrument is None:
+            return method(self, *args, **kwargs)
+        return self.instrument.measure(self, method, args, kwargs)
+    return wrapper
+
+
+# the sim's state from before each command, for undo and redo
+#
+# the sims never change agents, store columns or the lists holding them once they're made:
+#  commands make new lists and stores, and equipment is noted on copies. so a checkpoint
+#  only holds references, sharing whatever the command after it kept with the current state.
+#  each is charged an estimate of what it alone keeps alive (mostly what the command
+#  dropped), and the oldest are dropped while the total is over max_bytes. the newest is
+#  always kept
+class UndoStack():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.undo_list=[] # (command name, state, log mark, bytes) for each command, oldest first
+        self.redo_list=[] # the same, plus the state after and the log lines of each undone command
+        self.depth = 0 # commands running, so the commands a command runs aren't checkpointed
+
+    def total_bytes(self):
+        return sum(c[3] for c in self.undo_list)
+
+    def push(self, name, state, mark, nbytes):
+        self.undo_list.append((name, state, mark, nbytes))
+        self.redo_list=[]
+        total = self.total_bytes()
+        while total > self.max_bytes and len(self.undo_list) > 1:
+            total -= self.undo_list.pop(0)[3]
+
+
+# checkpoints the sim before each command, if it has an UndoStack
+def undoable(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        undo = self.undo_stack
+        if undo is None or undo.depth > 0:
+            return method(self, *args, **kwargs)
+        state = self.save_state()
+        mark = self.fdo.mark() if self.fdo is not None else None
+        undo.depth += 1
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            undo.depth -= 1
+        undo.push(method.__name__, state, mark, self.state_bytes(state))
+        return result
+    return wrapper
+
+
+# what a hunter would learn by looking from somewhere, worked out from a snapshot of the
+#  particles that is only read: the weight of the agents in each cell and, while "stealth
+#  field" could be in play, hiders, the agents that could use it to stay unseen in a LOS
+#  (see SimBase.__stealth_agent). hiders is a ParticleStore of them, or a dict of their total
+#  weight by cell index then turn mask
+#
+# evaluate(hp) returns the chance the agent would be spotted from hp and the expected
+#  entropy, in bits, of the heatmap once the hunter has looked. being spotted leaves a single
+#  cell, so only not being spotted adds to the entropy, that of the weight w left in each
+#  cell with W left in all:
+#   H = log W - sum(w log w) / W
+#  the cells out of the LOS keep all their weight, so the sum starts from that of every cell
+#  and each hp only goes over the cells in its LOS
+class WhatIf():
+    def __init__(self, board, cell_weight, hiders=None):
+        self.board = board
+        self.cell_weight = cell_weight
+        self.hiders = hiders
+        if isinstance(hiders, ParticleStore):
+            # sorted by cell, so those in cell i are the rows from bounds[i] to bounds[i+1]
+            self.hiders = hiders.select(np.argsort(hiders.end, kind='stable'))
+            self.hiders.agents = None
+            self.bounds = np.searchsorted(self.hiders.end, np.arange(N_ROWS*N_COLS+1)).tolist()
+        self.total = sum(cell_weight)
+        self.wlogw = sum(w * math.log(w) for w in cell_weight if w > 0)
+
+    # the weight of the hiders in each cell of los that would stay unseen
+    def hidden(self, los, los_close):
+        hidden={}
+        if self.hiders is None:
+            return hidden
+        if isinstance(self.hiders, ParticleStore):
+            for i in Board.mask_cells(los):
+                lo, hi = self.bounds[i], self.bounds[i+1]
+                if lo < hi:
+                    rows = self.hiders.select(slice(lo, hi))
+                    hidden[i] = float(rows.weight[~rows.touches(los_close)].sum())
+        else:
+            for i in Board.mask_cells(los):
+                for turn_mask, weight in self.hiders.get(i, {}).items():
+                    if not turn_mask & los_close:
+                        hidden[i] = hidden.get(i, 0) + weight
+        return hidden
+
+    def evaluate(self, hp):
+        if self.total <= 0:
+            return 0.0, 0.0
+        los = self.board.hunter_los_mask(hp)
+        hidden = self.hidden(los, los & self.board.range_mask(hp, STEALTH_RANGE))
+        seen = 0
+        wlogw = self.wlogw
+        for i in Board.mask_cells(los):
+            w = self.cell_weight[i]
+            if w > 0:
+                h = hidden.get(i, 0)
+                seen += w - h
+                wlogw -= w * math.log(w) - (h * math.log(h) if h > 0 else 0)
+        left = self.total - seen
+        entropy = max(0.0, math.log(left) - wlogw / left) / math.log(2) if left > 0 else 0.0
+        return seen / self.total, entropy * left / self.total
+
+
+# what Sim and BeliefSim share: the log, checkpoints, undo, reading commands and the
+#  observations that only keep the particles consistent with them. those are made as
+#  ParticleFilters, which each sim applies to its agents or rows with apply_filter
+class SimBase():
+    AGENT_UNKNOWN=-1
+    AGENT_OTHER=0
+    AGENT_BLUEJAY=1
+    PROGRESS_STEP=256 # agents expanded between calls to progress
+
+    def __init__(self, instrument, workers, checkpoint_every, undo_bytes, flush_every, fsync_every, quiet):
+        self.board = Board()
+        self.instrument = instrument # Instrument measuring each command, if any
+        # with more than one worker, propagation (in Sim) and what_if are split across a pool
+        #  of processes
+        self.workers = workers if 'fork' in multiprocessing.get_all_start_methods() else 1
+        self.prop_count = 0
+        self.agent_id = self.AGENT_UNKNOWN
+        self.equip_used = 0 # 0: none, 1: apply this propagation, 2: apply during obs and cancel at next prop
+        self.mission_pos=[]
+        self.merge_counts=[] # number of agents merged by the collapse at the start of each propagation
+        self.resample_errors=[] # ess and total variation of the heatmap for each resampling
+        # while propagating, progress (if set) is called with the number of agents expanded so
+        #  far and the number to expand. cancel() can be called from another thread
+        self.progress = None
+        self.cancel_requested = False
+        # with checkpoint_every and out_file, a snapshot is saved next to the log every that
+        #  many propagations
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_lines = 0 # log lines the last snapshot covers
+        # with undo_bytes, each command can be undone, keeping about that many bytes of old
+        #  states (see UndoStack)
+        self.undo_stack = UndoStack(undo_bytes) if undo_bytes is not None else None
+        # how often the log is flushed and synced, see LogFile
+        self.flush_every = flush_every
+        self.fsync_every = fsync_every
+        self.quiet = quiet # nothing printed while reading in_file
+
+    # opens the log to write, then loads the snapshot (if any) and reads the input log from
+    #  where the snapshot left off
+    #
+    # with both, the log to write starts as a copy of the input log (or is the same file), so
+    #  the commands read from it don't have to be written again
+    def open_files(self, in_file, out_file, snapshot):
+        self.fdo = None
+        if out_file is not None:
+            append = in_file is not None
+            same = append and os.path.exists(out_file) and os.path.samefile(in_file, out_file)
+            if append and not same:
+                shutil.copyfile(in_file, out_file)
+            self.fdo = LogFile(out_file, self.flush_every, self.fsync_every, append)
+        lines = 0
+        if snapshot is not None:
+            lines = self.load_snapshot(snapshot)
+        if in_file is not None:
+            self.fdi = open(in_file, 'rt')
+            # the commands the snapshot covers are skipped, but still copied to the new log
+            for i in range(lines):
+                l = self.fdi.readline()
+                if self.fdo is not None:
+                    self.fdo.write(l)
+            self.init_from_file(lines+1)
+            self.fdi.close()
+            if self.fdo is not None and same and self.fdo.unread() > 0:
+                # the lines not read are the user's, so they're never cut from the input
+                n = self.fdo.unread()
+                self.fdo.close()
+                self.fdo = None
+                raise ValueError('%s has %d lines after the commands read, which logging to it would lose; '
+                                 'give another --output' % (out_file, n))
+            if self.fdo is not None:
+                # only a copy of the input gets here
+                n = self.fdo.drop_unread()
+                if n > 0:
+                    print('dropped the last %d lines of %s, which were not read' % (n, out_file))
+
+    # syncs and closes the log
+    def close(self):
+        if self.fdo is not None:
+            self.fdo.close()
+
+    # called at the start of each propagation, so a checkpoint has all of a turn's observations
+    def checkpoint(self):
+        if self.checkpoint_every is None or self.fdo is None:
+            return
+        if self.prop_count > 0 and self.prop_count % self.checkpoint_every == 0:
+            self.save_snapshot(self.fdo.path + '.snap')
+            self.checkpoint_lines = self.fdo.lines
+            print('checkpoint after propagation %d' % self.prop_count)
+
+    # puts the sim back to how it was before the last command, and takes the command out of
+    #  the log. returns the command's name, or None if there's nothing to undo
+    def undo(self):
+        undo = self.undo_stack
+        if undo is None or len(undo.undo_list) == 0:
+            print('nothing to undo')
+            return None
+        name, before, mark, nbytes = undo.undo_list.pop()
+        after = self.save_state()
+        text = self.fdo.truncate(mark) if self.fdo is not None else ''
+        undo.redo_list.append((name, before, mark, nbytes, after, text))
+        self.restore_state(before)
+        # a snapshot covering more of the log than is left no longer matches it
+        if self.fdo is not None and self.checkpoint_lines > self.fdo.lines:
+            os.remove(self.fdo.path + '.snap')
+            self.checkpoint_lines = 0
+        print('undid %s' % name)
+        return name
+
+    # does the last undone command again, returning its name, or None if there's nothing to
+    #  redo. the redo list is emptied by any other command
+    def redo(self):
+        undo = self.undo_stack
+        if undo is None or len(undo.redo_list) == 0:
+            print('nothing to redo')
+            return None
+        name, before, mark, nbytes, after, text = undo.redo_list.pop()
+        self.restore_state(after)
+        if self.fdo is not None:
+            self.fdo.write(text)
+        undo.undo_list.append((name, before, mark, nbytes))
+        print('redid %s' % name)
+        return name
+
+    # first_line is the line number in the log of the next line of fdi
+    #
+    # with quiet, nothing is printed until the whole log has been read
+    def init_from_file(self, first_line=1):
+        read = 0
+        unknown = None
+        with open(os.devnull, 'wt') if self.quiet else contextlib.nullcontext(sys.stdout) as out:
+            with contextlib.redirect_stdout(out):
+                for line_num, t in read_log(self.fdi, first_line):
+                    if not self.run_command(t):
+                        unknown = t[0]
+                        break
+                    read += 1
+                # the log is read, so make the agents of a lazy propagation
+                self.materialize()
+        if unknown is not None:
+            print('unknown command %s' % unknown)
+        if self.quiet:
+            print('read %d commands from the log' % read)
+
+    # applies one command from a log file, split into tokens
+    # returns False if the command isn't recognised
+    def run_command(self, t):
+        c = self.parse_command(t)
+        if c is None:
+            return False
+        if c[0] == 'propagate':
+            self.propagate()
+        else:
+            getattr(self, c[0] + '_obs')(*c[1:])
+        return True
+
+    # returns a command from a log file, split into tokens, as ('propagate',) or an
+    #  observation for apply_observations. returns None if the command isn't recognised
+    def parse_command(self, t):
+        if t[0] == 'propagate':
+            return ('propagate',)
+        elif t[0] == 'spotted':
+            ap=BoardPosition.from_string('' if t[1] == '??' else t[1])
+            hp=BoardPosition.from_string(t[2])
+            return ('spotted', ap, hp)
+        elif t[0] == 'last_seen':
+            ap=BoardPosition.from_string('' if t[1] == '??' else t[1])
+            hp=BoardPosition.from_string(t[2])
+            return ('last_seen', ap, hp)
+        elif t[0] == 'motion':
+            cp=BoardPosition.from_string(t[1])
+            return ('motion', cp, t[2])
+        elif t[0] == 'sniffed':
+            hp=BoardPosition.from_string(t[1])
+            return ('sniffed', hp, t[2] == 'True')
+        elif t[0] == 'mission':
+            mp=BoardPosition.from_string(t[1])
+            return ('mission', mp)
+        elif t[0] == 'precog':
+            return ('precog',)
+        elif t[0] == 'postcog':
+            ap=BoardPosition.from_string(t[1])
+            return ('postcog', ap)
+        elif t[0] == 'flash':
+            gp=BoardPosition.from_string(t[1])
+            return ('equip', gp, Agent.EQUIP_FLASH)
+        elif t[0] == 'smoke':
+            gp=BoardPosition.from_string(t[1])
+            return ('equip', gp, Agent.EQUIP_SMOKE)
+        elif t[0] == 'unique':
+            return ('equip', None, Agent.EQUIP_UNIQUE)
+        elif t[0] == 'hidden':
+            return ('equip', None, Agent.EQUIP_HIDDEN)
+        elif t[0] == 'identity':
+            return ('identity', self.AGENT_BLUEJAY if t[1] == 'bluejay' else self.AGENT_OTHER)
+        return None
+
+    # stops a propagation running in another thread, which raises PropagationCancelled
+    def cancel(self):
+        self.cancel_requested = True
+
+    # called for each agent expanded while propagating
+    def propagation_step(self, done, total):
+        if self.cancel_requested:
+            raise PropagationCancelled()
+        if self.progress is not None and done % self.PROGRESS_STEP == 0:
+            self.progress(done, total)
+
+    # for each hunter position (with its facing) in candidates, returns the chance a hunter
+    #  there would spot the agent and the expected entropy of the heatmap after they look, as
+    #  a dict, see WhatIf. with workers, the candidates are split across a pool forked after
+    #  the snapshot is taken, so every worker reads the same one
+    def what_if(self, candidates):
+        what_if = self.what_if_snapshot()
+        if self.workers > 1 and len(candidates) > self.workers:
+            global _worker_what_if
+            _worker_what_if = what_if
+            n = len(candidates)
+            shards = [candidates[n*i//self.workers:n*(i+1)//self.workers] for i in range(self.workers)]
+            with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+                results = [r for shard in pool.map(_what_if_shard, shards) for r in shard]
+            _worker_what_if = None
+        else:
+            results = [what_if.evaluate(hp) for hp in candidates]
+        return [{'detection': p, 'entropy': h} for p, h in results]
+
+    # stealth field check for spotted/last seen, for an agent in the LOS: if the agent played
+    #  equipment that could have been "stealth field", keep them if they were in the LOS but
+    #  never closer than 3 spaces, noting the equipment
+    # also, it's possible they just played "adrenal surge", in which case they can't have
+    #  played "stealth field"
+    @staticmethod
+    def __stealth_agent(a, los_close):
+        if a.num_equip_possible(Agent.EQUIP_STEALTH) > 0 and len(a.get_turn()) <= NUM_MOVES_PER_TURN+1:
+            if not a.turn_mask() & los_close:
+                a.set_equip(Agent.EQUIP_STEALTH)
+                return True
+        return False
+
+    # vectorized stealth field check: of the rows in the LOS, returns those that could have
+    #  played "stealth field" and were never within stealth range, noting the equipment
+    @staticmethod
+    def __stealth_rows(store, in_los, los_close, stealth):
+        if not stealth:
+            return np.zeros(len(store), dtype=bool)
+        rows = (in_los & (store.num_equip_possible(Agent.EQUIP_STEALTH) > 0) &
+                (store.length <= NUM_MOVES_PER_TURN+1) & ~store.touches(los_close))
+        store.set_equip(rows, Agent.EQUIP_STEALTH)
+        return rows
+
+    # ap is the location the agent was spotted (empty if not spotted)
+    # hp is the location of the observant hunter
+    @undoable
+    @instrumented
+    def spotted_obs(self, ap, hp):
+        self.apply_filter(self.__spotted_filter(ap, hp))
+
+    # the filter methods log and print their observation, and return its ParticleFilter
+    def __spotted_filter(self, ap, hp):
+        if self.fdo is not None:
+            self.fdo.record('spotted', str(ap), str(hp))
+        if self.board.contains(ap):
+            print('spotted from %s at %s' % (str(hp), str(ap)))
+            # keep all agents at ap
+            i = ap.index()
+            return ParticleFilter(lambda a: a.get_position() == i, lambda store: store.end == i)
+        print('not in LOS from %s' % str(hp))
+        # keep all agents that are not in hunter LOS
+        los = self.board.hunter_los_mask(hp)
+        # cells in LOS where a stealthed agent would still be seen
+        los_close = los & self.board.range_mask(hp, STEALTH_RANGE)
+        stealth = self.equip_used == 2
+        def keep(a):
+            if not los & (1 << a.get_position()):
+                return True
+            return stealth and self.__stealth_agent(a, los_close)
+        def rows(store):
+            in_los = ParticleStore.cells(los)[store.end]
+            return ~in_los | self.__stealth_rows(store, in_los, los_close, stealth)
+        return ParticleFilter(keep, rows, notes_equip=stealth)
+
+    # ap is the location the agent was last seen (empty if not seen)
+    # hp is the location of the observant hunter
+    @undoable
+    @instrumented
+    def last_seen_obs(self, ap, hp):
+        if not self.board.contains(ap):
+            self.apply_filter(self.__not_seen_filter(ap, hp))
+            return
+        if self.fdo is not None:
+            self.fdo.record('last_seen', str(ap), str(hp))
+        print('last seen from %s at %s' % (str(hp), str(ap)))
+        # this restricts the move sequences and adds decoys, so it's more than a filter
+        self.last_seen_at(ap, self.board.hunter_los_mask(hp))
+
+    def __not_seen_filter(self, ap, hp):
+        if self.fdo is not None:
+            self.fdo.record('last_seen', str(ap), str(hp))
+        print('not seen crossing LOS of %s' % str(hp))
+        # keep agents that didn't cross LOS, or agents that played equipment that could have
+        #  used "stealth field"
+        los = self.board.hunter_los_mask(hp)
+        los_close = los & self.board.range_mask(hp, STEALTH_RANGE)
+        stealth = self.equip_used == 2
+        def keep(a):
+            if not a.turn_mask() & los:
+                return True
+            return stealth and self.__stealth_agent(a, los_close)
+        def rows(store):
+            in_los = store.touches(los)
+            return ~in_los | self.__stealth_rows(store, in_los, los_close, stealth)
+        return ParticleFilter(keep, rows, notes_equip=stealth, cost=2)
+
+    # mp is the location of the completed mission objective
+    @undoable
+    @instrumented
+    def mission_obs(self, mp):
+        self.apply_filter(self.__mission_filter(mp))
+
+    def __mission_filter(self, mp):
+        if self.fdo is not None:
+            self.fdo.record('mission', str(mp))
+        print('misson %s' % str(mp))
+        self.mission_pos.append(mp)
+        # keep agents that started adjacent to the mission objective
+        # if agent is known to not be bluejay, agent must have started within one space of the objective
+        # otherwise, they could have started within two spaces
+        if self.agent_id == self.AGENT_OTHER:
+            adj = self.board.adjacent_mask(mp, only_passable=True)
+        else:
+            adj = self.board.adjacent_mask(mp,dist=2, only_passable=True)
+        # look for where they started their turn in the positions next to the objective
+        return ParticleFilter(lambda a: adj & (1 << a.get_turn()[0]),
+                              lambda store: ParticleStore.cells(adj)[store.start])
+
+    # cp is the location of the car
+    # d is either the direction motion was detected (e.g. NW, E, etc) or empty string for no motion
+    @undoable
+    @instrumented
+    def motion_obs(self, cp, d):
+        self.apply_filter(self.__motion_filter(cp, d))
+
+    def __motion_filter(self, cp, d):
+        if self.fdo is not None:
+            self.fdo.record('motion', str(cp), str(d))
+        if d == 'none':
+            print('no motion')
+            # keep all agents whose last turn pos list length is less than motion detect thresh
+            return ParticleFilter(lambda a: len(a.get_turn()) < MOTION_DETECT_MOVES + 1,
+                                  lambda store: store.length < MOTION_DETECT_MOVES + 1)
+        print('motion to the %s of %s' % (d, str(cp)))
+        # keep all agents in the given direction and whose last turn pos list length
+        #   is greater than motion detect thresh
+        mask = self.board.motion_mask(cp, d)
+        return ParticleFilter(lambda a: mask & (1 << a.get_position()) and len(a.get_turn()) >= MOTION_DETECT_MOVES + 1,
+                              lambda store: ParticleStore.cells(mask)[store.end] & (store.length >= MOTION_DETECT_MOVES + 1))
+
+    # hp is the location of the hunter (beast)
+    # sniffed is true if the agent was detected, false otherwise
+    @undoable
+    @instrumented
+    def sniffed_obs(self, hp, sniffed):
+        self.apply_filter(self.__sniffed_filter(hp, sniffed))
+
+    def __sniffed_filter(self, hp, sniffed):
+        if self.fdo is not None:
+            self.fdo.record('sniffed', str(hp), 'True' if sniffed else 'False')
+        sniff = self.board.range_mask(hp, SNIFF_RANGE)
+        if sniffed:
+            print('sniffed near %s' % str(hp))
+            # keep all agents within 4 spaces of hp
+            return ParticleFilter(lambda a: sniff & (1 << a.get_position()),
+                                  lambda store: ParticleStore.cells(sniff)[store.end])
+        print('not sniffed near %s' % str(hp))
+        # keep all agents not within 4 spaces of hp
+        return ParticleFilter(lambda a: not sniff & (1 << a.get_position()),
+                              lambda store: ~ParticleStore.cells(sniff)[store.end])
+
+    @undoable
+    @instrumented
+    def precog_obs(self):
+        self.apply_filter(self.__precog_filter())
+
+    def __precog_filter(self):
+        if self.fdo is not None:
+            self.fdo.record('precog')
+        print('precog')
+        # only keep agents adjacent to any mission objective
+        # if agent is known to not be bluejay, agent must have ended within one space of the objective
+        # otherwise, they could have ended within two spaces
+        if self.agent_id == self.AGENT_OTHER:
+            near = self.board.objective_near_mask(1)
+        else:
+            near = self.board.objective_near_mask(2)
+        return ParticleFilter(lambda a: near & (1 << a.get_position()),
+                              lambda store: ParticleStore.cells(near)[store.end])
+
+    # ap is the location of the agent two turns ago
+    @undoable
+    @instrumented
+    def postcog_obs(self, ap):
+        if self.prop_count < 2:
+            print('postcog at %s ignored, there is no position two turns ago yet' % str(ap))
+            return
+        self.apply_filter(self.__postcog_filter(ap))
+
+    def __postcog_filter(self, ap):
+        if self.fdo is not None:
+            self.fdo.record('postcog', str(ap))
+        print('postcog at %s' % str(ap))
+        # only keep agents who were at ap two turns ago
+        i = ap.index()
+        return ParticleFilter(lambda a: a.get_position(-3) == i, lambda store: store.prev == i)
+
+    # logs a filtering observation and returns its filter, or returns None for an observation
+    #  that does more than filter the agents. name and args are as for apply_observations
+    def observation_filter(self, name, args):
+        if name == 'spotted':
+            return self.__spotted_filter(*args)
+        elif name == 'last_seen' and not self.board.contains(args[0]):
+            return self.__not_seen_filter(*args)
+        elif name == 'mission':
+            return self.__mission_filter(*args)
+        elif name == 'motion':
+            return self.__motion_filter(*args)
+        elif name == 'sniffed':
+            return self.__sniffed_filter(*args)
+        elif name == 'precog':
+            return self.__precog_filter(*args)
+        elif name == 'postcog' and self.prop_count >= 2:
+            return self.__postcog_filter(*args)
+        return None
+
+    @undoable
+    @instrumented
+    def equip_obs(self, ep, e_type):
+        # equipment changes the agents' equipment lists, so it needs the agents
+        self.materialize()
+        self.apply_filter(self.__equip_filter(ep, e_type))
+
+    # keep agents that have an unused equipment slot for it, noting the equipment. grenades
+    #  also need the agent to have been within 4 spaces of ep at any point during their last turn
+    def __equip_filter(self, ep, e_type):
+        grenade = None
+        if e_type == Agent.EQUIP_FLASH or e_type == Agent.EQUIP_SMOKE:
+            name = 'flash' if e_type == Agent.EQUIP_FLASH else 'smoke'
+            if self.fdo is not None:
+                self.fdo.record(name, str(ep))
+            print('%s grenade at %s' % (name, str(ep)))
+            if e_type == Agent.EQUIP_SMOKE:
+                self.board.place_smoke(ep)
+            grenade = self.board.range_mask(ep, GRENADE_RANGE)
+        elif e_type == Agent.EQUIP_UNIQUE:
+            if self.fdo is not None:
+                self.fdo.record('unique')
+            print('agent\'s unique equipment used')
+        else:
+            if self.fdo is not None:
+                self.fdo.record('hidden')
+            print('hidden equipment used')
+            # note that some hidden equipment was used
+            self.equip_used = 1
+        def keep(a):
+            if a.num_equip_possible(e_type) > 0 and (grenade is None or a.turn_mask() & grenade):
+                a.set_equip(e_type)
+                return True
+            return False
+        def rows(store):
+            rows = store.num_equip_possible(e_type) > 0
+            if grenade is not None:
+                rows &= store.touches(grenade)
+            store.set_equip(rows, e_type)
+            return rows
+        return ParticleFilter(keep, rows, notes_equip=True)
+
+    @undoable
+    @instrumented
+    def identity_obs(self, ident):
+        if self.fdo is not None:
+            self.fdo.record('identity', 'bluejay' if ident == self.AGENT_BLUEJAY else 'other')
+        print('id: %s' % ('bluejay' if ident == self.AGENT_BLUEJAY else 'other'))
+        self.agent_id = ident
+
+
+class Sim(SimBase):
+    ENGINE_PATHS='paths' # every move sequence becomes its own agent
+    ENGINE_REACH='reach' # move sequences are grouped into ReachTurn classes with a multiplicity
+    ENGINE_BELIEF='belief' # no agents, a BeliefSim over the states the agent could be in
+    RESAMPLE_SYSTEMATIC='systematic' # one random offset for evenly spaced picks
+    RESAMPLE_STRATIFIED='stratified' # a random pick within each of max_particles equal strata
+    SELECTIVITY_SAMPLE=1000 # agents checked to estimate how many an observation keeps
+    AGENT_BYTES=130 # an agent and its share of the history, see Agent
+
+    def __init__(self, in_file=None, out_file=None, engine=ENGINE_PATHS, vectorize=True, workers=1, instrument=None,
+                 max_particles=None, resample=RESAMPLE_SYSTEMATIC, seed=0, lazy=False, snapshot=None,
+                 checkpoint_every=None, undo_bytes=None, flush_every=1, fsync_every=None, quiet=False):
+        SimBase.__init__(self, instrument, workers, checkpoint_every, undo_bytes, flush_every, fsync_every, quiet)
+        # with max_particles, propagation resamples the agents down to that many by weight
+        #  (bounded mode). without, every agent is kept (exact mode)
+        self.max_particles = max_particles
+        self.resample = resample
+        self.rnd = random.Random(seed)
+        self.engine = engine
+        # with numpy available, observations work on a column store of the agents
+        self.vectorize = vectorize and np is not None
+        self.store = None
+        self.store_list = None # the agent list the store was built from
+        # self.agent_list[i] is the turn history for agent i
+        # self.agent_list[i][j] is the move sequence for agent i's turn j
+        # self.agent_list[i][j][k] is the kth position of agent i's jth turn
+        self.agent_list=[Agent()]
+        # in lazy mode, propagate only works out which turns each collapsed agent can take.
+        #  the observations that follow queue their filters, and the children are made (and
+        #  filtered on the way) when something needs the agents, so only the survivors are
+        #  ever stored. max_particles then applies to the survivors
+        self.lazy = lazy
+        self.pending = None # (agent, turns, store columns) for each collapsed agent while propagation is lazy
+        self.pending_filters=[]
+
+        self.open_files(in_file, out_file, snapshot)
+
+    # the state for UndoStack. the store is a new ParticleStore with the same columns, as
+    #  set_equip replaces its columns
+    def save_state(self):
+        return (self.agent_list, copy.copy(self.store), self.store_list, self.pending, list(self.pending_filters),
+                self.prop_count, self.agent_id, self.equip_used, self.board.smokep, list(self.mission_pos),
+                list(self.merge_counts), list(self.resample_errors), self.rnd.getstate())
+
+    def restore_state(self, state):
+        (self.agent_list, store, self.store_list, self.pending, pending_filters, self.prop_count, self.agent_id,
+         self.equip_used, smokep, mission_pos, merge_counts, resample_errors, rnd) = state
+        self.store = copy.copy(store)
+        self.pending_filters = list(pending_filters)
+        self.mission_pos = list(mission_pos)
+        self.merge_counts = list(merge_counts)
+        self.resample_errors = list(resample_errors)
+        self.rnd.setstate(rnd)
+        restore_smoke(self.board, smokep)
+
+    # estimate of the bytes only state keeps alive, once the command after it has run: its
+    #  agent list, its store's columns and the agents the command dropped
+    def state_bytes(self, state):
+        agent_list, store, prop_count = state[0], state[1], state[5]
+        if agent_list is self.agent_list:
+            return 0
+        n = len(agent_list)
+        # propagation replaces every agent
+        dropped = n if prop_count != self.prop_count else max(0, n - len(self.agent_list))
+        nbytes = 8*n + self.AGENT_BYTES*dropped
+        if store is not None:
+            nbytes += store.nbytes(self.store)
+        return nbytes
+
+    # collapse agents that share a particle key into a single representative agent, summing
+    #  their weights
+    #
+    # as long as all observations are processed, all remaining paths are equally likely
+    # for simplicity we keep the history of the first agent to reach a given position with
+    # a given set of equipment
+    #
+    # returns the collapsed list (in order of first appearance) and the number of agents merged
+    @staticmethod
+    def collapse(agent_list):
+        unique_agents={}
+        for agent in agent_list:
+            k = agent.key()
+            rep = unique_agents.get(k)
+            if rep is None:
+                # we don't already have this key, so the agent becomes the representative
+                unique_agents[k] = [agent, agent.weight]
+            else:
+                # we've already got it, so increase the weight of the representative agent
+                rep[1] += agent.weight
+        trimmed_agents = [Sim.reweighted(agent, weight) for agent, weight in unique_agents.values()]
+        return trimmed_agents, len(agent_list) - len(trimmed_agents)
+
+    # returns agent with the given weight: the agent itself if it has it, otherwise a copy, as
+    #  agents aren't changed once made (see UndoStack)
+    @staticmethod
+    def reweighted(agent, weight):
+        if weight == agent.weight:
+            return agent
+        a = Agent()
+        a.clone(agent)
+        a.weight = weight
+        return a
+
+    @undoable
+    @instrumented
+    def propagate(self):
+        self.materialize()
+        self.checkpoint()
+        # the agents are only replaced at the end, so only these need putting back
+        saved = (self.prop_count, self.board.smokep, self.equip_used, len(self.merge_counts))
+        self.cancel_requested = False
+        try:
+            self.__propagate()
+        except PropagationCancelled:
+            self.prop_count, smokep, self.equip_used, n = saved
+            if smokep is not None and self.board.smokep is None:
+                self.board.place_smoke(smokep)
+            del self.merge_counts[n:]
+            print('propagation cancelled')
+            raise
+        # only logged once it's done, a cancelled propagation never happened
+        if self.fdo is not None:
+            self.fdo.record('propagate', str(self.prop_count))
+
+    def __propagate(self):
+        self.prop_count += 1
+
+        # first, clean up any smoke grenades from last turn
+        if self.board.smokep is not None:
+            self.board.clear_smoke()
+            print('cleared smoke')
+
+        if self.equip_used == 2:
+            self.equip_used = 0
+
+        # the possible turns only depend on where the agent starts and how far they can move,
+        #  so compute them (and their store columns) once for each
+        tables={}
+        blocks=[]
+        if self.workers > 1:
+            global _worker_sim
+            _worker_sim = self
+            with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+                trimmed_agents, merged, parents = self.__collapse_parallel(pool)
+                if not self.lazy:
+                    tables, blocks = self.__expand_parallel(pool, parents)
+            _worker_sim = None
+        else:
+            # we don't actually care about detailed history once the hunter turn is over.
+            # therefore, before propagating we can ignore any differences in how agents moved
+            # between end turn locations and collapse those that have the same end history and
+            # equipment lists
+            trimmed_agents, merged = self.collapse(self.agent_list)
+        self.merge_counts.append(merged)
+        print('trimmed %d -> %d (%d merged)' % (len(self.agent_list), len(trimmed_agents), merged))
+        # TODO: unique list is a good place to check for equipment that all agent particles have
+
+        if self.lazy:
+            pending=[]
+            for i, agent in enumerate(trimmed_agents):
+                self.propagation_step(i, len(trimmed_agents))
+                turns, columns = self.__turn_table(agent, tables)
+                pending.append((agent, turns, columns))
+            self.pending = pending
+            self.pending_filters=[]
+        else:
+            new_agents=[]
+            # we're going to propagate every tracked agent to all the places they could go, each becoming a new agent
+            for i, agent in enumerate(trimmed_agents):
+                self.propagation_step(i, len(trimmed_agents))
+                turns, columns = self.__turn_table(agent, tables)
+                new_agents.extend(self.__children(agent, turns))
+                if columns is not None and self.workers == 1:
+                    blocks.append(ParticleStore.children(agent, columns))
+            self.agent_list = new_agents
+            if self.vectorize:
+                # build the store for the observations from the columns of each agent's turns
+                self.store = ParticleStore.concatenate(blocks, new_agents)
+                self.store_list = self.agent_list
+
+            if self.max_particles is not None and len(self.agent_list) > self.max_particles:
+                self.__resample()
+        if self.progress is not None:
+            self.progress(len(trimmed_agents), len(trimmed_agents))
+
+        if self.equip_used == 1:
+            self.equip_used = 2
+
+    # yields a new agent for agent taking each of turns
+    def __children(self, agent, turns):
+        # now, all these new moves turn into agent particles with the same shared history
+        for t in turns:
+            new_agent = Agent()
+            new_agent.clone(agent)
+            new_agent.add_turn(t)
+            if self.engine == self.ENGINE_REACH:
+                # the agent stands in for every sequence in the class
+                new_agent.weight *= t.count
+            if len(t) > NUM_MOVES_PER_TURN+1:
+                new_agent.set_equip(Agent.EQUIP_SURGE)
+            yield new_agent
+
+    # true while a lazy propagation's children haven't been made
+    def streaming(self):
+        return self.pending is not None
+
+    # makes the children of a lazy propagation, keeping those that pass every filter queued
+    #  since. does nothing otherwise
+    def materialize(self):
+        if self.pending is None:
+            return
+        filters = self.pending_filters
+        # the filters that don't note equipment can be checked on the store rows for each
+        #  agent's children, so the children they drop are never made. they don't look at
+        #  the equipment either, so checking them first keeps the same agents
+        masks = [f for f in filters if not f.notes_equip]
+        notes = [f for f in filters if f.notes_equip]
+        new_agents=[]
+        for agent, turns, columns in self.pending:
+            checks = filters
+            if columns is not None and len(masks) > 0:
+                block = ParticleStore.children(agent, columns)
+                keep = masks[0].rows(block)
+                for f in masks[1:]:
+                    keep = keep & f.rows(block)
+                turns = [turns[i] for i in np.flatnonzero(keep)]
+                checks = notes
+            for a in self.__children(agent, turns):
+                for f in checks:
+                    if not f.keep(a):
+                        break
+                else:
+                    new_agents.append(a)
+        self.pending = None
+        self.pending_filters=[]
+        self.agent_list = new_agents
+        if self.max_particles is not None and len(self.agent_list) > self.max_particles:
+            self.__resample()
+
+    # returns how many times each weight is picked when n picks are made with probability
+    #  proportional to weight, using rnd for the random offsets
+    #
+    # systematic picks are spaced total/n apart from one random offset, stratified picks
+    #  are independent within each of the n spaces. either way a weight w is picked within
+    #  one of w*n/total times
+    @staticmethod
+    def resample_counts(weights, n, rnd, stratified=False):
+        total = sum(weights)
+        step = total / n
+        u = rnd.random()
+        counts=[]
+        cum = 0
+        i = 0 # next pick
+        for w in weights:
+            cum += w
+            c = 0
+            while i < n and (i + u) * step < cum:
+                c += 1
+                i += 1
+                if stratified:
+                    u = rnd.random()
+            counts.append(c)
+        return counts
+
+    # resample the agents down to max_particles by weight. an agent picked more than once is
+    #  kept once with the weight of all its picks, which all get the same share of the total
+    #
+    # the error is estimated from the effective sample size of the weights beforehand and the
+    #  total variation distance between the heatmaps before and after
+    def __resample(self):
+        n = len(self.agent_list)
+        weights = [a.weight for a in self.agent_list]
+        total = sum(weights)
+        ess = total * total / sum(w * w for w in weights)
+        counts = self.resample_counts(weights, self.max_particles, self.rnd, self.resample == self.RESAMPLE_STRATIFIED)
+        step = total / self.max_particles
+        before={}
+        after={}
+        new_list=[]
+        for a, c in zip(self.agent_list, counts):
+            p = a.get_position()
+            before[p] = before.get(p, 0) + a.weight
+            if c > 0:
+                a.weight = c * step
+                after[p] = after.get(p, 0) + a.weight
+                new_list.append(a)
+        tv = sum(abs(w - after.get(p, 0)) for p, w in before.items()) / (2.0 * total)
+        self.resample_errors.append((ess, tv))
+        print('resampled %d -> %d (ess %.0f, total variation %.4f)' % (n, len(new_list), ess, tv))
+        if self.store is not None and self.store_list is self.agent_list:
+            self.__keep(np.array(counts) > 0)
+            self.store.weight = np.array([a.weight for a in new_list], dtype=np.float64)
+        else:
+            self.agent_list = new_list
+
+    # returns the possible turns for agent and their store columns, from tables if they've
+    #  been computed for the same start position and number of moves already
+    def __turn_table(self, agent, tables):
+        # propagation starts at the last position in their history
+        start_pos = agent.get_position()
+        max_num_moves = self.__max_num_moves(agent)
+        k = (start_pos, max_num_moves)
+        if k not in tables:
+            tables[k] = self.board.walk_table(start_pos, max_num_moves, self.engine == self.ENGINE_REACH, self.vectorize)
+        return tables[k]
+
+    # the parallel collapse gives each worker a contiguous slice of the agent list to collapse,
+    #  then merges their representatives in slice order, so the surviving agents, their order
+    #  and their weights are the same as collapse() and don't depend on the number of workers
+    #
+    # also returns the index in the agent list and collapsed weight of each, for
+    #  __expand_parallel
+    def __collapse_parallel(self, pool):
+        n = len(self.agent_list)
+        bounds = [(n*i//self.workers, n*(i+1)//self.workers) for i in range(self.workers)]
+        unique_agents={}
+        for shard in pool.map(_collapse_shard, bounds):
+            for k, i, weight in shard:
+                rep = unique_agents.get(k)
+                if rep is None:
+                    unique_agents[k] = [i, weight]
+                else:
+                    rep[1] += weight
+        parents = list(unique_agents.values())
+        trimmed_agents = [self.reweighted(self.agent_list[i], weight) for i, weight in parents]
+        return trimmed_agents, n - len(trimmed_agents), parents
+
+    # runs in a worker: collapses agent_list[lo:hi], returning the key, index and total weight
+    #  of each representative
+    def collapse_shard(self, lo, hi):
+        unique_agents={}
+        for i in range(lo, hi):
+            agent = self.agent_list[i]
+            k = agent.key()
+            rep = unique_agents.get(k)
+            if rep is None:
+                unique_agents[k] = [i, agent.weight]
+            else:
+                rep[1] += agent.weight
+        return [(k, i, weight) for k, (i, weight) in unique_agents.items()]
+
+    # the workers work out the store rows (and any turn tables the board doesn't have yet) for
+    #  contiguous slices of the trimmed agents. the new agents themselves are still made here:
+    #  sending them back costs more than making them
+    def __expand_parallel(self, pool, parents):
+        n = len(parents)
+        shards = [parents[n*i//self.workers:n*(i+1)//self.workers] for i in range(self.workers)]
+        tables={}
+        blocks=[]
+        for shard_tables, shard_blocks in pool.map(_expand_shard, shards):
+            for k, v in shard_tables.items():
+                if k not in tables:
+                    tables[k] = v
+                    self.board.add_walk_table(k[0], k[1], self.engine == self.ENGINE_REACH, v)
+            blocks.extend(shard_blocks)
+        return tables, blocks
+
+    # runs in a worker: the store rows for the children of each (agent index, collapsed weight)
+    #  in parents, and the turn tables the board didn't already have
+    def expand_shard(self, parents):
+        grouped = self.engine == self.ENGINE_REACH
+        tables={}
+        new_tables={}
+        blocks=[]
+        for i, weight in parents:
+            agent = self.agent_list[i]
+            agent.weight = weight
+            k = (agent.get_position(), self.__max_num_moves(agent))
+            built = k not in tables and k + (grouped,) not in self.board.walk_tables
+            turns, columns = self.__turn_table(agent, tables)
+            if built:
+                new_tables[k] = tables[k]
+            if columns is not None:
+                blocks.append(ParticleStore.children(agent, columns))
+        # one block for the whole slice is much quicker to send back
+        if len(blocks) > 0:
+            blocks = [ParticleStore.concatenate(blocks, None)]
+        return new_tables, blocks
+
+    # num moves can depend on if the agent plays "adrenal surge"
+    def __max_num_moves(self, agent):
+        if self.equip_used == 1 and agent.num_equip_possible(Agent.EQUIP_SURGE) > 0:
+            return NUM_MOVES_PER_TURN_SURGE
+        return NUM_MOVES_PER_TURN
+
+    # returns the probability of the agent being in each cell, as a list of rows of N_COLS
+    def posterior(self):
+        prob = self.cell_probabilities([0] * (N_ROWS*N_COLS))
+        return [prob[r*N_COLS:(r+1)*N_COLS] for r in range(N_ROWS)]
+
+    # fills prob, a list with an entry per cell index, with the chance of the agent being in
+    #  each cell. the list is reused so redrawing doesn't build a new grid every time
+    def cell_probabilities(self, prob):
+        self.materialize()
+        for i in range(len(prob)):
+            prob[i] = 0
+        total_weight = sum(a.weight for a in self.agent_list) * 1.0
+        for agent in self.agent_list:
+            prob[agent.get_position()] += agent.weight / total_weight
+        return prob
+
+    def what_if_snapshot(self):
+        self.materialize()
+        cell_weight = [0] * (N_ROWS*N_COLS)
+        for agent in self.agent_list:
+            cell_weight[agent.get_position()] += agent.weight
+        hiders = None
+        if self.equip_used == 2 and self.store is not None and self.store_list is self.agent_list:
+            store = self.store
+            hiders = store.select((store.num_equip_possible(Agent.EQUIP_STEALTH) > 0) & (store.length <= NUM_MOVES_PER_TURN+1))
+        elif self.equip_used == 2:
+            hiders={}
+            for a in self.agent_list:
+                if a.num_equip_possible(Agent.EQUIP_STEALTH) > 0 and len(a.get_turn()) <= NUM_MOVES_PER_TURN+1:
+                    by_mask = hiders.setdefault(a.get_position(), {})
+                    m = a.turn_mask()
+                    by_mask[m] = by_mask.get(m, 0) + a.weight
+        return WhatIf(self.board, cell_weight, hiders)
+
+    def num_particles(self):
+        self.materialize()
+        return len(self.agent_list)
+
+    def total_weight(self):
+        self.materialize()
+        return sum(a.weight for a in self.agent_list)
+
+    # number of distinct TurnNodes holding the history of the current agents
+    def num_history_nodes(self):
+        self.materialize()
+        seen=set()
+        for a in self.agent_list:
+            n = a.node
+            while n is not None and id(n) not in seen:
+                seen.add(id(n))
+                n = n.parent
+        return len(seen)
+
+    # writes the sim to a Snapshot file at path: the board's smoke, the equipment and identity
+    #  state, the missions and every agent with its weight, equipment and history. the
+    #  histories are written as a table of TurnNodes, parents first, so shared turns are
+    #  written once
+    def save_snapshot(self, path):
+        self.materialize()
+        if self.fdo is not None:
+            self.fdo.flush()
+        index={}
+        nodes=[]
+        for a in self.agent_list:
+            chain=[]
+            n = a.node
+            while n is not None and id(n) not in index:
+                chain.append(n)
+                n = n.parent
+            for n in reversed(chain):
+                index[id(n)] = len(nodes)
+                nodes.append(n)
+        snap = Snapshot()
+        snap.add_state(self)
+        snap.add('NPAR', 'i', [index[id(n.parent)] if n.parent is not None else -1 for n in nodes])
+        snap.add_turns('T', [n.turn for n in nodes])
+        snap.add('ANOD', 'i', [index[id(a.node)] for a in self.agent_list])
+        slots = len(self.agent_list[0].equip_list) if len(self.agent_list) > 0 else 0
+        snap.add('AEQP', 'b', [e for a in self.agent_list for e in a.equip_list])
+        # weights are whole numbers of paths unless they've been resampled, and can outgrow 64 bits
+        weights = [a.weight for a in self.agent_list]
+        if any(isinstance(w, float) for w in weights):
+            snap.add('AWGT', 'd', weights)
+            width = 0
+        else:
+            width = max([(w.bit_length() + 8) // 8 for w in weights] + [1])
+            snap.add('AWGT', 'B', b''.join(w.to_bytes(width, 'little') for w in weights))
+        snap.add('ASIZ', 'q', [slots, width])
+        # the resampling generator, so a resumed game resamples as the original would have
+        #  (gauss() isn't used, so its cached value isn't kept)
+        version, state, gauss = self.rnd.getstate()
+        snap.add('RAND', 'Q', (version,) + state)
+        snap.write(path)
+
+    # replaces the sim's state with a snapshot from save_snapshot, and returns the number of
+    #  lines of the log it was taken at
+    def load_snapshot(self, path):
+        snap = Snapshot.read(path)
+        lines = snap.load_state(self)
+        turns = snap.get_turns('T', self.board.passable_neighbors())
+        nodes=[]
+        for parent, t in zip(snap.get('NPAR'), turns):
+            if parent < 0 and t == Agent.START_NODE.turn:
+                nodes.append(Agent.START_NODE)
+            else:
+                nodes.append(TurnNode(nodes[parent] if parent >= 0 else None, t))
+        slots, width = snap.get('ASIZ')
+        equip = snap.get('AEQP')
+        weights = snap.get('AWGT')
+        equip_lists={} # agents share equal equipment tuples, as clones do
+        agent_list=[]
+        for i, n in enumerate(snap.get('ANOD')):
+            a = Agent(slots)
+            e = tuple(equip[i*slots:(i+1)*slots])
+            a.equip_list = equip_lists.setdefault(e, e)
+            a.node = nodes[n]
+            a.weight = weights[i] if width == 0 else int.from_bytes(weights[i*width:(i+1)*width], 'little')
+            agent_list.append(a)
+        self.agent_list = agent_list
+        rnd = snap.get('RAND')
+        self.rnd.setstate((rnd[0], tuple(rnd[1:]), None))
+        self.store = None
+        self.store_list = None
+        self.pending = None
+        self.pending_filters=[]
+        print('loaded snapshot %s: %d agents after propagation %d' % (path, len(agent_list), self.prop_count))
+        return lines
+
+    # returns the column store for the current agent list (building it if the list has
+    #  changed), or None if observations aren't vectorized
+    def __store(self):
+        if not self.vectorize:
+            return None
+        if self.store is None or self.store_list is not self.agent_list:
+            self.store = ParticleStore.from_agents(self.agent_list)
+            self.store_list = self.agent_list
+        return self.store
+
+    # keep the agents in the store where keep is true
+    def __keep(self, keep):
+        self.store = self.store.select(keep)
+        self.agent_list = self.store.agents.tolist()
+        self.store_list = self.agent_list
+
+    # applies an observation's filter: queued for the children of a lazy propagation, to the
+    #  store's columns when vectorized, otherwise agent by agent
+    def apply_filter(self, f):
+        if self.pending is not None:
+            self.pending_filters.append(f)
+            return
+        store = self.__store()
+        if store is not None:
+            self.__keep(f.rows(store))
+            return
+        if f.notes_equip:
+            # equipment is noted on copies of the agents, see UndoStack
+            self.agent_list = [a for a in map(self.__copy, self.agent_list) if f.keep(a)]
+            return
+        self.agent_list = [a for a in self.agent_list if f.keep(a)]
+
+    @staticmethod
+    def __copy(agent):
+        a = Agent()
+        a.clone(agent)
+        return a
+
+    # see SimBase.last_seen_obs, los is the hunter's
+    def last_seen_at(self, ap, los):
+        # this restricts the turns and adds decoys, so it needs the agents
+        self.materialize()
+        new_list=[]
+        for a in self.agent_list:
+            #  keep move sequences that passed through ap and didn't end in ap and weren't
+            #  visible through a later LOS
+            paths=[]
+            for t in a.turn_paths():
+                idx = [i for i,v in enumerate(t[:-1]) if v == ap.index()]
+                #  agent passed through ap so they definitely were spotted
+                if len(idx) > 0:
+                    # now for the moves after where the agent last passed through ap, make sure none
+                    #  are in the hunter LOS
+                    idx = idx[-1]
+                    if not los & Board.cells_mask(t[idx+1:]):
+                        paths.append(t)
+            # if the agent could be bluejay and has not played their unique ability card
+            #  then create a clone of this agent who has played "holo decoy" and keep them
+            #  anyway
+            # TODO: remember that last seen will positively identify the agent!
+            if self.agent_id != self.AGENT_OTHER and a.num_equip_possible(Agent.EQUIP_UNIQUE) > 0:
+                b = Agent()
+                b.clone(a)
+                b.set_equip(Agent.EQUIP_UNIQUE)
+            else:
+                b = None
+            if len(paths) > 0:
+                # restricted on a copy, see UndoStack
+                a = self.__copy(a)
+                a.restrict_turn(paths)
+                new_list.append(a)
+            if b is not None:
+                new_list.append(b)
+        self.agent_list = new_list
+
+    # applies the observations from a hunter turn together, with the same result as applying
+    #  them one at a time. batch is a list of tuples of an observation method's name without
+    #  _obs and its arguments, e.g. ('spotted', ap, hp) or ('equip', ep, e_type)
+    #
+    # each run of observations that only filter the agents is fused into a single pass, with
+    #  the filters that keep the fewest agents for the least work first. the other
+    #  observations are applied in order between the runs
+    @undoable
+    @instrumented
+    def apply_observations(self, batch):
+        filters=[]
+        for obs in batch:
+            f = self.observation_filter(obs[0], obs[1:])
+            if f is not None:
+                filters.append(f)
+                continue
+            self.__apply_fused(filters)
+            filters=[]
+            getattr(self, obs[0] + '_obs')(*obs[1:])
+        self.__apply_fused(filters)
+
+    # applies filters in one pass over the agents. filters that note equipment are checked
+    #  last, in order. the others don't look at the equipment, so they can go in any order:
+    #  by the work per agent they take for each agent they drop, estimated from a sample
+    def __apply_fused(self, filters):
+        if len(filters) == 0:
+            return
+        masks = [f for f in filters if not f.notes_equip]
+        notes = [f for f in filters if f.notes_equip]
+        if self.pending is not None:
+            # the children are checked when they're made
+            self.pending_filters.extend(masks + notes)
+            return
+        store = self.__store()
+        n = len(self.agent_list)
+        step = max(1, n // self.SELECTIVITY_SAMPLE)
+        if store is not None:
+            sample = store.select(np.arange(0, n, step))
+            kept = [float(f.rows(sample).mean()) if len(sample) > 0 else 1.0 for f in masks]
+        else:
+            sample = self.agent_list[::step]
+            kept = [sum(1 for a in sample if f.keep(a)) / len(sample) if len(sample) > 0 else 1.0 for f in masks]
+        order = sorted(range(len(masks)), key=lambda i: masks[i].cost / max(1.0 - kept[i], 1e-6))
+        masks = [masks[i] for i in order]
+        filters = masks + notes
+        if store is not None:
+            # each filter only looks at the rows the ones before it kept
+            for f in filters:
+                store = store.select(f.rows(store))
+            self.store = store
+            self.agent_list = store.agents.tolist()
+            self.store_list = self.agent_list
+            return
+        new_list=[]
+        for a in self.agent_list:
+            for f in masks:
+                if not f.keep(a):
+                    break
+            else:
+                if len(notes) > 0:
+                    # equipment is noted on a copy, see UndoStack
+                    a = self.__copy(a)
+                    if not all(f.keep(a) for f in notes):
+                        continue
+                new_list.append(a)
+        self.agent_list = new_list
+
+
+# an alternative to Sim for when only the heatmap is needed, with no agents or histories
+#
+# the belief is a store of rows, one for each turn class (see Board.reach_classes) the agent
+#  could have taken from each state it could have been in, weighted by the number of move
+#  sequences it stands for. a state is the equipment, start and end of the last turn, which
+#  is all the next turn depends on, so propagation sums the rows into states and expands each
+#  state with the board's walk tables. the work depends on how many states the board allows,
+#  not on how many move sequences lead to them
+#
+# every observation is a mask (or an equipment change) over the rows, except last seen at a
+#  position, which needs the move sequences of the rows that pass through it
+#
+# requires numpy
+class BeliefSim(SimBase):
+
+    def __init__(self, in_file=None, out_file=None, instrument=None, snapshot=None, checkpoint_every=None,
+                 undo_bytes=None, flush_every=1, fsync_every=None, quiet=False, workers=1):
+        if np is None:
+            raise ImportError('BeliefSim needs numpy')
+        SimBase.__init__(self, instrument, workers, checkpoint_every, undo_bytes, flush_every, fsync_every, quiet)
+        self.engine = Sim.ENGINE_BELIEF
+        self.rows = ParticleStore.from_agents([Agent()])
+        self.rows.agents = None
+        # the ReachTurn of each row once last seen has restricted its move sequences, or None
+        #  when no row has been
+        self.turns = None
+
+        self.open_files(in_file, out_file, snapshot)
+
+    # see Sim.save_state
+    def save_state(self):
+        return (copy.copy(self.rows), self.turns, self.prop_count, self.agent_id, self.equip_used, self.board.smokep,
+                list(self.mission_pos), list(self.merge_counts))
+
+    def restore_state(self, state):
+        rows, self.turns, self.prop_count, self.agent_id, self.equip_used, smokep, mission_pos, merge_counts = state
+        self.rows = copy.copy(rows)
+        self.mission_pos = list(mission_pos)
+        self.merge_counts = list(merge_counts)
+        restore_smoke(self.board, smokep)
+
+    def state_bytes(self, state):
+        return state[0].nbytes(self.rows)
+
+    # every observation is already a single pass over the rows, so they're just applied in
+    #  order. see Sim.apply_observations
+    @undoable
+    @instrumented
+    def apply_observations(self, batch):
+        for obs in batch:
+            getattr(self, obs[0] + '_obs')(*obs[1:])
+
+    # see Sim.save_snapshot. the rows are written as they are
+    def save_snapshot(self, path):
+        if self.fdo is not None:
+            self.fdo.flush()
+        rows = self.rows
+        snap = Snapshot()
+        snap.add_state(self)
+        for tag, c in (('REND', rows.end), ('RSTA', rows.start), ('RPRV', rows.prev), ('RLEN', rows.length),
+                       ('REQP', rows.equip), ('RWGT', rows.weight), ('RVIS', rows.visited)):
+            c = np.ascontiguousarray(c)
+            snap.add(tag, 'B', c.tobytes())
+        if self.turns is not None:
+            restricted = [i for i in range(len(rows)) if self.turns[i] is not None]
+            snap.add('TROW', 'i', restricted)
+            snap.add_turns('T', [self.turns[i] for i in restricted])
+        snap.write(path)
+
+    # see Sim.load_snapshot. the columns are numpy views of the arrays Snapshot.read filled,
+    #  which are the snapshot's own, so none is copied again
+    def load_snapshot(self, path):
+        snap = Snapshot.read(path)
+        lines = snap.load_state(self)
+        n = len(snap.get('RWGT')) // 8
+        def column(tag, dtype):
+            return np.frombuffer(snap.get(tag), dtype=dtype)
+        self.rows = ParticleStore(None, column('REND', '<i2'), column('RSTA', '<i2'), column('RPRV', '<i2'),
+                                  column('RLEN', 'i1'), column('REQP', 'i1').reshape(n, ParticleStore.N_EQUIP_TYPES),
+                                  column('RWGT', '<f8'),
+                                  column('RVIS', '<u8').reshape(n, ParticleStore.N_MASK_WORDS))
+        self.turns = None
+        if 'TROW' in snap.sections:
+            self.turns = np.empty(n, dtype=object)
+            for i, t in zip(snap.get('TROW'), snap.get_turns('T', self.board.passable_neighbors())):
+                self.turns[i] = t
+        print('loaded snapshot %s: %d rows after propagation %d' % (path, n, self.prop_count))
+        return lines
+
+    # no lazy propagation, see Sim
+    def streaming(self):
+        return False
+
+    def materialize(self):
+        pass
+
+    def num_particles(self):
+        return len(self.rows)
+
+    def total_weight(self):
+        return float(self.rows.weight.sum())
+
+    def posterior(self):
+        return self.cell_probabilities(np.zeros(N_ROWS*N_COLS)).reshape(N_ROWS, N_COLS).tolist()
+
+    # see Sim.what_if_snapshot
+    def what_if_snapshot(self):
+        rows = self.rows
+        cell_weight = np.bincount(rows.end, weights=rows.weight, minlength=N_ROWS*N_COLS).tolist()
+        hiders = None
+        if self.equip_used == 2:
+            hiders = rows.select((rows.num_equip_possible(Agent.EQUIP_STEALTH) > 0) & (rows.length <= NUM_MOVES_PER_TURN+1))
+        return WhatIf(self.board, cell_weight, hiders)
+
+    def cell_probabilities(self, prob):
+        total = self.rows.weight.sum()
+        prob[:] = np.bincount(self.rows.end, weights=self.rows.weight, minlength=N_ROWS*N_COLS) / (total if total > 0 else 1)
+        return prob
+
+    def __keep(self, keep):
+        self.rows = self.rows.select(keep)
+        if self.turns is not None:
+            self.turns = self.turns[keep]
+
+    # see SimBase
+    def apply_filter(self, f):
+        self.__keep(f.rows(self.rows))
+
+    @undoable
+    @instrumented
+    def propagate(self):
+        self.checkpoint()
+        # the rows are only replaced at the end, see Sim.propagate
+        saved = (self.prop_count, self.board.smokep, self.equip_used, len(self.merge_counts))
+        self.cancel_requested = False
+        try:
+            self.__propagate()
+        except PropagationCancelled:
+            self.prop_count, smokep, self.equip_used, n = saved
+            if smokep is not None and self.board.smokep is None:
+                self.board.place_smoke(smokep)
+            del self.merge_counts[n:]
+            print('propagation cancelled')
+            raise
+        if self.fdo is not None:
+            self.fdo.record('propagate', str(self.prop_count))
+
+    def __propagate(self):
+        self.prop_count += 1
+
+        if self.board.smokep is not None:
+            self.board.clear_smoke()
+            print('cleared smoke')
+
+        if self.equip_used == 2:
+            self.equip_used = 0
+
+        # sum the rows into states, in order of their first row like Sim.collapse
+        rows = self.rows
+        key = np.column_stack([rows.equip, rows.start, rows.end])
+        key, first, inverse = np.unique(key, axis=0, return_index=True, return_inverse=True)
+        weight = np.bincount(inverse.reshape(-1), weights=rows.weight, minlength=len(first))
+        order = np.argsort(first)
+        states = rows.select(first[order])
+        states.weight = weight[order]
+        self.merge_counts.append(len(rows) - len(states))
+        print('trimmed %d -> %d (%d merged)' % (len(rows), len(states), len(rows) - len(states)))
+
+        # num moves can depend on if the agent plays "adrenal surge"
+        surge = states.num_equip_possible(Agent.EQUIP_SURGE) > 0
+        blocks=[]
+        for i in range(len(states)):
+            self.propagation_step(i, len(states))
+            start = int(states.end[i])
+            max_num_moves = NUM_MOVES_PER_TURN_SURGE if self.equip_used == 1 and surge[i] else NUM_MOVES_PER_TURN
+            turns, columns = self.board.walk_table(start, max_num_moves, grouped=True, columns=True)
+            # the first propagation starts from the start of the game, which has no turn before it
+            prev = int(states.start[i]) if self.prop_count > 1 else -1
+            blocks.append(ParticleStore.expand(states.equip[i], start, prev, states.weight[i], columns))
+        if self.progress is not None:
+            self.progress(len(states), len(states))
+        if len(blocks) > 0:
+            self.rows = ParticleStore.concatenate(blocks, None)
+        else:
+            self.rows = states
+        self.turns = None
+
+        if self.equip_used == 1:
+            self.equip_used = 2
+
+    # see SimBase.last_seen_obs
+    def last_seen_at(self, ap, los):
+        rows = self.rows
+        # the same as Sim.last_seen_at, for the move sequences of each row's turn class
+        nbrs = self.board.passable_neighbors()
+        through = rows.touches(1 << ap.index())
+        decoy = (rows.num_equip_possible(Agent.EQUIP_UNIQUE) > 0) & (self.agent_id != self.AGENT_OTHER)
+        keep=[]
+        weights=[]
+        turns=[]
+        decoys=[]
+        for i in range(len(rows)):
+            t = self.turns[i] if self.turns is not None else None
+            if through[i]:
+                if t is None:
+                    mask = int.from_bytes(rows.visited[i].tobytes(), 'little')
+                    t = ReachTurn(int(rows.start[i]), int(rows.end[i]), mask, int(rows.length[i])-1, 1, nbrs)
+                    # the row's whole class, with the real number of move sequences in it (it's
+                    #  also kept for a decoy)
+                    t = t.restricted(t.paths())
+                all_paths = t.paths()
+                paths=[]
+                for p in all_paths:
+                    idx = [j for j,v in enumerate(p[:-1]) if v == ap.index()]
+                    if len(idx) > 0 and not los & Board.cells_mask(p[idx[-1]+1:]):
+                        paths.append(p)
+                if len(paths) > 0:
+                    keep.append(i)
+                    weights.append(rows.weight[i] * len(paths) / len(all_paths))
+                    turns.append(t.restricted(paths))
+                    decoys.append(False)
+            if decoy[i]:
+                keep.append(i)
+                weights.append(rows.weight[i])
+                turns.append(t)
+                decoys.append(True)
+        self.rows = rows.select(np.array(keep, dtype=np.intp))
+        self.rows.weight = np.array(weights, dtype=np.float64)
+        self.turns = np.empty(len(turns), dtype=object)
+        for i, t in enumerate(turns):
+            self.turns[i] = t
+        self.rows.set_equip(np.array(decoys, dtype=bool), Agent.EQUIP_UNIQUE)
+
+
+# returns a BeliefSim for ENGINE_BELIEF, otherwise a Sim with the given engine. the other
+#  arguments are for Sim, and those BeliefSim doesn't take are ignored
+def make_sim(engine=Sim.ENGINE_PATHS, in_file=None, out_file=None, instrument=None, **kwargs):
+    if engine == Sim.ENGINE_BELIEF:
+        return BeliefSim(in_file=in_file, out_file=out_file, instrument=instrument, snapshot=kwargs.get('snapshot'),
+                         checkpoint_every=kwargs.get('checkpoint_every'), undo_bytes=kwargs.get('undo_bytes'),
+                         flush_every=kwargs.get('flush_every', 1), fsync_every=kwargs.get('fsync_every'),
+                         quiet=kwargs.get('quiet', False), workers=kwargs.get('workers', 1))
+    return Sim(in_file=in_file, out_file=out_file, engine=engine, instrument=instrument, **kwargs)